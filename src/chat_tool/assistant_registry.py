@@ -0,0 +1,127 @@
+"""
+Assistant注册表 - 按 (system_prompt哈希, 模型, 工具) 复用OpenAI Assistant
+"""
+
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from .file_utils import atomic_write_json
+from .rate_limiter import ASSISTANTS_LANE, RateLimiter
+
+# 写入Assistant metadata的标记，用于识别由注册表创建的Assistant
+REGISTRY_TAG = "chat_tool_registry"
+
+
+class AssistantRegistry:
+    def __init__(self, client, storage_file: str = "data/assistants.json",
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.client = client
+        self.storage_file = storage_file
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._assistants: Dict[str, str] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._load()
+
+    @staticmethod
+    def make_key(instructions: str, model: str, tools: Optional[List[Dict[str, Any]]] = None) -> str:
+        """Build the registry key for an assistant configuration"""
+        prompt_hash = hashlib.sha256((instructions or "").encode('utf-8')).hexdigest()
+        tools_json = json.dumps(tools or [], sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(f"{prompt_hash}|{model}|{tools_json}".encode('utf-8')).hexdigest()
+
+    def _load(self):
+        """Load the registry from disk"""
+        if not os.path.exists(self.storage_file):
+            return
+        try:
+            with open(self.storage_file, 'r', encoding='utf-8') as f:
+                self._assistants.update(json.load(f))
+        except Exception as e:
+            print(f"Error loading assistant registry: {e}")
+
+    def _save(self, dropped: Iterable[str] = ()):
+        """Merge with the on-disk registry, minus the dropped assistant ids, and write it back atomically"""
+        merged: Dict[str, str] = {}
+        if os.path.exists(self.storage_file):
+            try:
+                with open(self.storage_file, 'r', encoding='utf-8') as f:
+                    merged = json.load(f)
+            except Exception:
+                merged = {}
+        merged.update(self._assistants)
+        dropped = set(dropped)
+        if dropped:
+            merged = {k: v for k, v in merged.items() if v not in dropped}
+        self._assistants = merged
+        atomic_write_json(self.storage_file, merged)
+
+    async def get_assistant_id(self, instructions: str, model: str = "gpt-4o",
+                               tools: Optional[List[Dict[str, Any]]] = None,
+                               name: str = "Chat Assistant") -> str:
+        """Return the assistant for this configuration, creating it on first use"""
+        key = self.make_key(instructions, model, tools)
+        assistant_id = self._assistants.get(key)
+        if assistant_id:
+            return assistant_id
+
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            assistant_id = self._assistants.get(key)
+            if assistant_id:
+                return assistant_id
+
+            create_kwargs = {
+                "name": name,
+                "instructions": instructions,
+                "model": model,
+                "metadata": {REGISTRY_TAG: key[:64]}
+            }
+            if tools:
+                create_kwargs["tools"] = tools
+            async with self.rate_limiter.permit(ASSISTANTS_LANE):
+                assistant = await self.client.beta.assistants.create(**create_kwargs)
+            self._assistants[key] = assistant.id
+            self._save()
+            return assistant.id
+
+    def forget(self, assistant_id: str):
+        """Drop an assistant from the registry (e.g. it was deleted remotely)"""
+        self._save(dropped=[assistant_id])
+
+    async def reconcile(self, min_age: float = 3600, include_legacy: bool = False) -> int:
+        """Delete orphaned assistants and drop registry entries that no longer exist.
+
+        Only assistants tagged by this registry (or, with include_legacy, the untagged
+        "Chat Assistant" ones left behind by per-message creation) older than min_age
+        seconds are deleted, so freshly created assistants of other workers are kept.
+        """
+        # 重新读取磁盘上的注册表，包含其他worker新写入的条目
+        self._load()
+        known_ids = set(self._assistants.values())
+        remote_ids = set()
+        deleted = 0
+        cutoff = time.time() - min_age
+
+        async for assistant in self.client.beta.assistants.list(limit=100):
+            remote_ids.add(assistant.id)
+            metadata = assistant.metadata or {}
+            if assistant.id in known_ids:
+                continue
+            is_ours = REGISTRY_TAG in metadata
+            is_legacy = include_legacy and not metadata and assistant.name == "Chat Assistant"
+            if (is_ours or is_legacy) and assistant.created_at < cutoff:
+                try:
+                    await self.client.beta.assistants.delete(assistant.id)
+                    deleted += 1
+                except Exception as e:
+                    print(f"Error deleting orphaned assistant {assistant.id}: {e}")
+
+        stale = {v for v in self._assistants.values() if v not in remote_ids}
+        if stale:
+            self._save(dropped=stale)
+
+        return deleted
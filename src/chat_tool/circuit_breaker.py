@@ -0,0 +1,130 @@
+"""
+熔断器 - 上游失败率或延迟超过阈值时快速失败，并通过半开探测恢复
+"""
+
+import os
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+from .resilience import is_retryable
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """Errors that indicate the model backend is unhealthy (not a bad request)"""
+    return is_retryable(error) or isinstance(error, TimeoutError)
+
+
+class CircuitBreaker:
+    """Failure-rate and slow-call breaker over a sliding window of calls.
+
+    Opens when enough recent calls failed or were slower than
+    ``slow_call_seconds``. After ``open_seconds`` it lets ``half_open_probes``
+    calls through; a healthy probe closes it again, a bad one reopens it.
+    """
+
+    def __init__(self, name: str, failure_rate: float = 0.5, slow_call_seconds: float = 20.0,
+                 slow_call_rate: float = 0.8, window: int = 20, min_calls: int = 5,
+                 open_seconds: float = 30.0, half_open_probes: int = 1):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self._outcomes: Deque[Tuple[bool, bool]] = deque(maxlen=window)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._stats = {"opened": 0, "rejected": 0}
+
+    @classmethod
+    def from_env(cls, name: str) -> 'CircuitBreaker':
+        """Build a breaker from BREAKER_* environment variables"""
+        return cls(
+            name,
+            failure_rate=float(os.getenv("BREAKER_FAILURE_RATE", 0.5)),
+            slow_call_seconds=float(os.getenv("BREAKER_SLOW_CALL_SECONDS", 20)),
+            slow_call_rate=float(os.getenv("BREAKER_SLOW_CALL_RATE", 0.8)),
+            window=int(os.getenv("BREAKER_WINDOW", 20)),
+            min_calls=int(os.getenv("BREAKER_MIN_CALLS", 5)),
+            open_seconds=float(os.getenv("BREAKER_OPEN_SECONDS", 30)),
+            half_open_probes=int(os.getenv("BREAKER_HALF_OPEN_PROBES", 1))
+        )
+
+    @property
+    def state(self) -> str:
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probes = 0
+        return self._state
+
+    def allow(self) -> bool:
+        """Whether a call may go upstream now; every allowed call must be recorded or released"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == HALF_OPEN and self._probes < self.half_open_probes:
+            self._probes += 1
+            return True
+        self._stats["rejected"] += 1
+        return False
+
+    def record_success(self, latency: float):
+        self._record(failed=False, slow=latency >= self.slow_call_seconds)
+
+    def record_failure(self):
+        self._record(failed=True, slow=False)
+
+    def release(self):
+        """An allowed call ended without telling anything about backend health"""
+        if self._state == HALF_OPEN and self._probes:
+            self._probes -= 1
+
+    def _record(self, failed: bool, slow: bool):
+        if self._state == HALF_OPEN:
+            self._probes = max(0, self._probes - 1)
+            if failed or slow:
+                self._open()
+            else:
+                self._close()
+            return
+        if self._state == OPEN:
+            return
+
+        self._outcomes.append((failed, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        failures = sum(1 for f, _ in self._outcomes if f) / len(self._outcomes)
+        slow_calls = sum(1 for _, s in self._outcomes if s) / len(self._outcomes)
+        if failures >= self.failure_rate or slow_calls >= self.slow_call_rate:
+            self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        self._stats["opened"] += 1
+        print(f"🔌 熔断器 {self.name} 已打开，{self.open_seconds:.0f}秒后开始探测")
+
+    def _close(self):
+        self._state = CLOSED
+        self._outcomes.clear()
+        self._probes = 0
+        print(f"✅ 熔断器 {self.name} 已恢复")
+
+    def stats(self) -> Dict[str, Any]:
+        """State and recent outcome rates"""
+        calls = len(self._outcomes)
+        return dict(
+            self._stats,
+            state=self.state,
+            calls=calls,
+            failure_rate=round(sum(1 for f, _ in self._outcomes if f) / calls, 3) if calls else 0.0,
+            slow_call_rate=round(sum(1 for _, s in self._outcomes if s) / calls, 3) if calls else 0.0
+        )
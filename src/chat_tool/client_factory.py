@@ -0,0 +1,144 @@
+"""
+OpenAI客户端工厂 - 进程内共享的HTTP连接池、超时与重试配置
+"""
+
+import os
+from typing import Any, Dict, Optional
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from .resilience import RetryPolicy
+
+
+def _http2_available() -> bool:
+    try:
+        import h2  # noqa: F401  HTTP/2需要可选依赖h2
+        return True
+    except ImportError:
+        return False
+
+
+class ClientFactory:
+    """Builds one shared AsyncOpenAI and one shared OpenAI client per API key.
+
+    Both clients use the same pool limits, timeouts and retry policy, so every
+    component reuses warm connections instead of opening its own pool.
+    """
+
+    def __init__(self, api_key: str, max_connections: int = 100, max_keepalive: int = 20,
+                 keepalive_expiry: float = 30.0, http2: bool = False, timeout: float = 120.0,
+                 connect_timeout: float = 10.0, max_retries: int = 2):
+        self.api_key = api_key
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.max_retries = max_retries
+        self.http2 = http2
+        if http2 and not _http2_available():
+            print("⚠️  未安装h2，HTTP/2已禁用 (pip install httpx[http2])")
+            self.http2 = False
+        self._async_client: Optional[AsyncOpenAI] = None
+        self._sync_client: Optional[OpenAI] = None
+
+    @classmethod
+    def from_env(cls, api_key: str) -> 'ClientFactory':
+        """Build a factory from OPENAI_* pool environment variables.
+
+        When RetryPolicy retries upstream steps (RETRY_ATTEMPTS > 1) the SDK's
+        own retries are turned off, so one step never sends attempts x retries requests.
+        """
+        max_retries = int(os.getenv("OPENAI_MAX_RETRIES", 2))
+        if RetryPolicy.from_env().attempts > 1 and max_retries:
+            if os.getenv("OPENAI_MAX_RETRIES"):
+                print("⚠️  RETRY_ATTEMPTS已启用重试，忽略OPENAI_MAX_RETRIES")
+            max_retries = 0
+        return cls(
+            api_key,
+            max_connections=int(os.getenv("OPENAI_MAX_CONNECTIONS", 100)),
+            max_keepalive=int(os.getenv("OPENAI_MAX_KEEPALIVE", 20)),
+            keepalive_expiry=float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", 30)),
+            http2=os.getenv("OPENAI_HTTP2", "False").lower() == "true",
+            timeout=float(os.getenv("OPENAI_TIMEOUT", 120)),
+            connect_timeout=float(os.getenv("OPENAI_CONNECT_TIMEOUT", 10)),
+            max_retries=max_retries
+        )
+
+    def async_client(self) -> AsyncOpenAI:
+        """The shared async client, created on first use"""
+        if self._async_client is None:
+            self._async_client = AsyncOpenAI(
+                api_key=self.api_key,
+                max_retries=self.max_retries,
+                timeout=self.timeout,
+                http_client=DefaultAsyncHttpxClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+            )
+        return self._async_client
+
+    def sync_client(self) -> OpenAI:
+        """The shared blocking client, created on first use"""
+        if self._sync_client is None:
+            self._sync_client = OpenAI(
+                api_key=self.api_key,
+                max_retries=self.max_retries,
+                timeout=self.timeout,
+                http_client=DefaultHttpxClient(limits=self.limits, timeout=self.timeout, http2=self.http2)
+            )
+        return self._sync_client
+
+    async def aclose(self):
+        """Close both clients and their connection pools"""
+        if self._async_client is not None:
+            await self._async_client.close()
+            self._async_client = None
+        if self._sync_client is not None:
+            self._sync_client.close()
+            self._sync_client = None
+
+    def pool_stats(self) -> Dict[str, Any]:
+        """Connection pool utilization of the clients created so far"""
+        stats: Dict[str, Any] = {
+            "max_connections": self.limits.max_connections,
+            "max_keepalive": self.limits.max_keepalive_connections,
+            "http2": self.http2
+        }
+        for name, client in (("async", self._async_client), ("sync", self._sync_client)):
+            if client is not None:
+                stats[name] = _pool_usage(client._client)
+        return stats
+
+
+def _pool_usage(http_client) -> Dict[str, int]:
+    # httpx没有公开连接池状态，这里读取底层httpcore连接池，取不到时返回0
+    pool = getattr(getattr(http_client, "_transport", None), "_pool", None)
+    connections = list(getattr(pool, "connections", []))
+    requests = list(getattr(pool, "_requests", []))
+    idle = sum(1 for connection in connections if connection.is_idle())
+    queued = sum(1 for request in requests if request.is_queued())
+    return {
+        "connections": len(connections),
+        "idle": idle,
+        "active_requests": len(requests) - queued,
+        "queued_requests": queued
+    }
+
+
+_factories: Dict[str, ClientFactory] = {}
+
+
+def get_client_factory(api_key: str) -> ClientFactory:
+    """The process-wide factory for an API key"""
+    factory = _factories.get(api_key)
+    if factory is None:
+        factory = _factories[api_key] = ClientFactory.from_env(api_key)
+    return factory
+
+
+async def close_client_factories():
+    """Close every shared client; called on application shutdown"""
+    for factory in list(_factories.values()):
+        await factory.aclose()
+    _factories.clear()
@@ -0,0 +1,109 @@
+"""
+请求合并 - 相同的并发请求共享一次上游调用，并把事件流分发给每个等待者
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+# 事件流正常结束的标记
+_END = object()
+
+
+class _Failure:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+class _Flight:
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+        self.queues: List[asyncio.Queue] = []
+        self.end: Optional[object] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+class SingleFlight:
+    """Runs one producer per key and fans its events out to every subscriber.
+
+    Subscribers that join late first receive the events emitted so far, so each
+    one sees the complete stream. The producer runs in its own task and is
+    cancelled once every subscriber has gone away.
+    """
+
+    def __init__(self):
+        self._flights: Dict[str, _Flight] = {}
+        self._coalesced = 0
+
+    def join(self, key: str,
+             factory: Callable[[], AsyncIterator[Dict[str, Any]]]) -> Tuple[AsyncIterator[Dict[str, Any]], bool]:
+        """Subscribe to the flight for key, starting it if needed.
+
+        Returns (events, leader); leader is True for the caller whose factory runs.
+        """
+        flight = self._flights.get(key)
+        leader = flight is None
+        if leader:
+            flight = _Flight()
+            self._flights[key] = flight
+        else:
+            self._coalesced += 1
+
+        queue: asyncio.Queue = asyncio.Queue()
+        for event in flight.events:
+            queue.put_nowait(event)
+        flight.queues.append(queue)
+
+        if leader:
+            flight.task = asyncio.create_task(self._run(key, flight, factory))
+        return self._subscribe(flight, queue), leader
+
+    def add_done_callback(self, key: str, callback: Callable[[], None]):
+        """Call callback once the producer for key has finished, or now if none is running"""
+        flight = self._flights.get(key)
+        if flight is None or flight.task is None:
+            callback()
+        else:
+            flight.task.add_done_callback(lambda _: callback())
+
+    async def _run(self, key: str, flight: _Flight, factory: Callable[[], AsyncIterator[Dict[str, Any]]]):
+        end: object = _END
+        try:
+            async for event in factory():
+                flight.events.append(event)
+                for queue in flight.queues:
+                    queue.put_nowait(event)
+        except asyncio.CancelledError as e:
+            end = _Failure(e)
+            raise
+        except Exception as e:
+            end = _Failure(e)
+        finally:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            flight.end = end
+            for queue in flight.queues:
+                queue.put_nowait(end)
+
+    async def _subscribe(self, flight: _Flight, queue: asyncio.Queue) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            while True:
+                item = await queue.get()
+                if item is _END:
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                # 每个订阅者拿到独立的事件副本
+                yield dict(item)
+        finally:
+            flight.queues.remove(queue)
+            # 所有订阅者都离开且尚未产出最终结果时，取消上游调用
+            if not flight.queues and flight.end is None and not self._answered(flight):
+                flight.task.cancel()
+
+    @staticmethod
+    def _answered(flight: _Flight) -> bool:
+        return bool(flight.events) and flight.events[-1].get("type") in ("done", "error")
+
+    def stats(self) -> Dict[str, int]:
+        """Flights running now and subscribers that shared one"""
+        return {"in_flight": len(self._flights), "coalesced": self._coalesced}
@@ -1,181 +1,319 @@
 import configparser
+import io
 import os
-from typing import Dict, Optional
+import threading
+from abc import ABC, abstractmethod
+from types import MappingProxyType
+from typing import Any, Callable, Dict, Iterable, Mapping, Optional, Tuple
 
-class SystemPromptManager:
-    def __init__(self, config_file: str = "config/system_prompts.ini"):
+from .file_utils import atomic_write_text, file_lock
+
+Sections = Dict[str, Dict[str, str]]
+
+
+class _IniConfig(ABC):
+    """An .ini file compiled into immutable lookup tables.
+
+    The getters only read ``self._tables``; ``reload()`` parses the file again
+    and replaces the tables in one assignment, so readers always see either the
+    old or the new snapshot. Values are interpolated like configparser's
+    defaults; ``raw=True`` reads them literally instead.
+
+    Writes go through ``_update()``: under an inter-process lock it re-reads
+    the file, applies the change, replaces the file atomically and bumps the
+    ``{config_file}.version`` sidecar, which the other workers' watchers see.
+    """
+
+    def __init__(self, config_file: str, raw: bool = False):
         self.config_file = config_file
-        self.config = configparser.ConfigParser()
+        self.raw = raw
+        self._signature: Optional[Tuple[int, int, int]] = None
+        self.version = 0
+        self._reload_lock = threading.Lock()
+        self._tables: Mapping[str, Any] = MappingProxyType({"sections": MappingProxyType({})})
         self._load_config()
 
+    @property
+    def config(self) -> Mapping[str, Mapping[str, str]]:
+        """Read-only view of the current sections"""
+        return self._tables["sections"]
+
     def _load_config(self):
-        """Load system prompts from configuration file"""
-        if os.path.exists(self.config_file):
-            self.config.read(self.config_file, encoding='utf-8')
-        else:
-            # Create default configuration if file doesn't exist
-            self._create_default_config()
-
-    def _create_default_config(self):
-        """Create default configuration file"""
-        os.makedirs(os.path.dirname(self.config_file), exist_ok=True)
-        
-        self.config['default'] = {
-            'name': '通用聊天助手',
-            'system_prompt': '你是一个有用的AI助手。请友善、准确地回答用户的问题。'
+        """Load the configuration file, creating the defaults if it doesn't exist"""
+        if not os.path.exists(self.config_file):
+            # 其他worker可能已在加锁期间创建了文件，此时保持不变
+            self._update(lambda sections: sections or self._default_sections())
+        self.reload(force=True)
+
+    @abstractmethod
+    def _default_sections(self) -> Sections:
+        """Contents of a newly created configuration file"""
+
+    @property
+    def version_file(self) -> str:
+        return f"{self.config_file}.version"
+
+    def _read_version(self) -> int:
+        try:
+            with open(self.version_file, encoding='utf-8') as f:
+                return int(f.read().strip() or 0)
+        except (FileNotFoundError, ValueError):
+            return 0
+
+    def _read_sections(self, raw: bool = True) -> Sections:
+        """Parse the file as it is on disk now"""
+        parser = configparser.ConfigParser(interpolation=None) if raw else configparser.ConfigParser()
+        with open(self.config_file, encoding='utf-8') as f:
+            parser.read_file(f)
+        return {name: dict(parser[name]) for name in parser.sections()}
+
+    def _update(self, change: Callable[[Sections], Sections]):
+        """Apply change to the current file contents under the config file lock"""
+        with file_lock(self.config_file):
+            # 在锁内重新读取磁盘上的文件，避免覆盖其他worker刚写入的修改
+            exists = os.path.exists(self.config_file)
+            current = self._read_sections() if exists else {}
+            updated = change({name: dict(section) for name, section in current.items()})
+            if updated != current or not exists:
+                # 按读取时的模式校验，插值语法错误的值在写入前就报错
+                parser = configparser.ConfigParser(interpolation=None) if self.raw else configparser.ConfigParser()
+                parser.read_dict(updated)
+                buffer = io.StringIO()
+                parser.write(buffer)
+                atomic_write_text(self.config_file, buffer.getvalue())
+                atomic_write_text(self.version_file, str(self._read_version() + 1))
+        self.reload(force=True)
+
+    def _set_section(self, name: str, values: Dict[str, str]):
+        self._update(lambda sections: {**sections, name: values})
+
+    def _file_signature(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            stat = os.stat(self.config_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, self._read_version()
+
+    def reload(self, force: bool = False) -> bool:
+        """Parse the file again if it changed; returns whether a new snapshot was swapped in"""
+        with self._reload_lock:
+            signature = self._file_signature()
+            if signature is None or (signature == self._signature and not force):
+                return False
+            try:
+                # 插值在编译时完成一次，请求路径上不再经过configparser
+                sections = MappingProxyType({
+                    name: MappingProxyType(section) for name, section in self._read_sections(self.raw).items()
+                })
+            except (OSError, UnicodeDecodeError, configparser.Error) as e:
+                # 写到一半或格式错误的文件不替换现有配置，文件再次变化时重试
+                if self._signature is None:
+                    # 首次加载没有旧配置可用
+                    raise
+                print(f"⚠️  配置文件解析失败，继续使用旧配置 {self.config_file}: {e}")
+                self._signature = signature
+                return False
+            self._tables = MappingProxyType(dict(self._compile(sections), sections=sections))
+            self._signature = signature
+            self.version = signature[2]
+            return True
+
+    def _compile(self, sections: Mapping[str, Mapping[str, str]]) -> Dict[str, Any]:
+        """Precomputed lookup tables for the getters"""
+        return {}
+
+
+class SystemPromptManager(_IniConfig):
+    _ROUTE_KEYS = ('model', 'fast_model', 'fast_max_tokens', 'fallback_model')
+
+    def __init__(self, config_file: str = "config/system_prompts.ini", raw: bool = False):
+        super().__init__(config_file, raw)
+
+    def _default_sections(self) -> Sections:
+        """Contents of a newly created configuration file"""
+        return {
+            'default': {
+                'name': '通用聊天助手',
+                'system_prompt': '你是一个有用的AI助手。请友善、准确地回答用户的问题。'
+            }
+        }
+
+    def _compile(self, sections: Mapping[str, Mapping[str, str]]) -> Dict[str, Any]:
+        default = sections.get('default', {})
+        route_options = {}
+        for name, section in sections.items():
+            options = {key: section.get(key, '').strip().strip('"') for key in self._ROUTE_KEYS}
+            route_options[name] = MappingProxyType({key: value for key, value in options.items() if value})
+        return {
+            "system_prompts": {name: section.get('system_prompt', '') for name, section in sections.items()},
+            "default_system_prompt": default.get('system_prompt', ''),
+            "names": {name: section.get('name', name) for name, section in sections.items()},
+            "default_name": default.get('name', 'Default'),
+            "route_options": route_options,
+            "default_route_options": route_options.get('default', MappingProxyType({}))
         }
-        
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            self.config.write(f)
 
     def get_system_prompt(self, prompt_type: str = "default") -> str:
         """Get system prompt by type"""
-        if prompt_type in self.config:
-            return self.config[prompt_type].get('system_prompt', '')
-        return self.config['default'].get('system_prompt', '')
+        tables = self._tables
+        return tables["system_prompts"].get(prompt_type, tables["default_system_prompt"])
 
     def get_prompt_name(self, prompt_type: str = "default") -> str:
         """Get prompt name by type"""
-        if prompt_type in self.config:
-            return self.config[prompt_type].get('name', prompt_type)
-        return self.config['default'].get('name', 'Default')
+        tables = self._tables
+        return tables["names"].get(prompt_type, tables["default_name"])
 
     def list_available_prompts(self) -> Dict[str, str]:
         """List all available prompt types with their names"""
-        prompts = {}
-        for section in self.config.sections():
-            prompts[section] = self.config[section].get('name', section)
-        return prompts
+        return dict(self._tables["names"])
+
+    def get_route_options(self, prompt_type: str = "default") -> Mapping[str, str]:
+        """Model routing options (model, fast_model, fast_max_tokens, fallback_model) for a prompt type"""
+        tables = self._tables
+        return tables["route_options"].get(prompt_type, tables["default_route_options"])
 
     def add_system_prompt(self, prompt_type: str, name: str, system_prompt: str):
         """Add a new system prompt"""
-        self.config[prompt_type] = {
+        self._set_section(prompt_type, {
             'name': name,
             'system_prompt': system_prompt
-        }
-        
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            self.config.write(f)
+        })
 
 
-class WelcomeMessageManager:
-    def __init__(self, config_file: str = "config/welcome_messages.ini"):
-        self.config_file = config_file
-        self.config = configparser.ConfigParser()
-        self._load_config()
+class WelcomeMessageManager(_IniConfig):
+    def __init__(self, config_file: str = "config/welcome_messages.ini", raw: bool = False):
+        super().__init__(config_file, raw)
 
-    def _load_config(self):
-        """Load welcome messages from configuration file"""
-        if os.path.exists(self.config_file):
-            self.config.read(self.config_file, encoding='utf-8')
-        else:
-            # Create default configuration if file doesn't exist
-            self._create_default_config()
-
-    def _create_default_config(self):
-        """Create default configuration file"""
-        os.makedirs(os.path.dirname(self.config_file), exist_ok=True)
-        
-        self.config['normal'] = {
-            'title': '欢迎使用大模型问答平台',
-            'message': '我是您的AI助手，具备广泛的知识基础，可以帮助您解答各种问题、提供信息查询、协助分析问题等。无论是学术研究、工作事务还是日常疑问，我都会尽力为您提供准确、有用的回答。请随时提出您的问题！'
-        }
-        
-        self.config['search'] = {
-            'title': '欢迎使用大模型问答平台',
-            'message': '我可以协助你找到权威的信息来源，并提供相应链接帮助你更便捷地获取相关信息。我会通过搜索功能获取最新的实时数据，确保为您提供准确、及时的信息。如果你准备好了就开始对话，我将和你一起完成任务！'
+    def _default_sections(self) -> Sections:
+        """Contents of a newly created configuration file"""
+        return {
+            'normal': {
+                'title': '欢迎使用大模型问答平台',
+                'message': '我是您的AI助手，具备广泛的知识基础，可以帮助您解答各种问题、提供信息查询、协助分析问题等。无论是学术研究、工作事务还是日常疑问，我都会尽力为您提供准确、有用的回答。请随时提出您的问题！'
+            },
+            'search': {
+                'title': '欢迎使用大模型问答平台',
+                'message': '我可以协助你找到权威的信息来源，并提供相应链接帮助你更便捷地获取相关信息。我会通过搜索功能获取最新的实时数据，确保为您提供准确、及时的信息。如果你准备好了就开始对话，我将和你一起完成任务！'
+            },
+            'nosystem': {
+                'title': '欢迎使用大模型问答平台',
+                'message': '这是一个自由对话模式，没有特定的系统提示约束。我将以最自然的方式与您交流，您可以畅所欲言，探讨任何感兴趣的话题。让我们开始一场轻松愉快的对话吧！'
+            }
         }
-        
-        self.config['nosystem'] = {
-            'title': '欢迎使用大模型问答平台',
-            'message': '这是一个自由对话模式，没有特定的系统提示约束。我将以最自然的方式与您交流，您可以畅所欲言，探讨任何感兴趣的话题。让我们开始一场轻松愉快的对话吧！'
+
+    def _compile(self, sections: Mapping[str, Mapping[str, str]]) -> Dict[str, Any]:
+        default_title = '欢迎使用大模型问答平台'
+        normal = sections.get('normal', {})
+        return {
+            "titles": {name: section.get('title', default_title) for name, section in sections.items()},
+            "default_title": normal.get('title', default_title),
+            "messages": {name: section.get('message', '') for name, section in sections.items()},
+            "default_message": normal.get('message', '')
         }
-        
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            self.config.write(f)
 
     def get_welcome_title(self, mode: str = "normal") -> str:
         """Get welcome title by mode"""
-        if mode in self.config:
-            return self.config[mode].get('title', '欢迎使用大模型问答平台')
-        return self.config['normal'].get('title', '欢迎使用大模型问答平台')
+        tables = self._tables
+        return tables["titles"].get(mode, tables["default_title"])
 
     def get_welcome_message(self, mode: str = "normal") -> str:
         """Get welcome message by mode"""
-        if mode in self.config:
-            return self.config[mode].get('message', '')
-        return self.config['normal'].get('message', '')
+        tables = self._tables
+        return tables["messages"].get(mode, tables["default_message"])
 
     def set_welcome_message(self, mode: str, title: str, message: str):
         """Set welcome message for a mode"""
-        self.config[mode] = {
+        self._set_section(mode, {
             'title': title,
             'message': message
-        }
-        
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            self.config.write(f)
+        })
 
 
-class ImplicitPromptManager:
-    def __init__(self, config_file: str = "config/implicit_prompts.ini"):
-        self.config_file = config_file
-        self.config = configparser.ConfigParser()
-        self._load_config()
+class ImplicitPromptManager(_IniConfig):
+    def __init__(self, config_file: str = "config/implicit_prompts.ini", raw: bool = False):
+        super().__init__(config_file, raw)
 
-    def _load_config(self):
-        """Load implicit prompts from configuration file"""
-        if os.path.exists(self.config_file):
-            self.config.read(self.config_file, encoding='utf-8')
-        else:
-            # Create default configuration if file doesn't exist
-            self._create_default_config()
-
-    def _create_default_config(self):
-        """Create default configuration file"""
-        os.makedirs(os.path.dirname(self.config_file), exist_ok=True)
-        
-        self.config['default'] = {
-            'name': '默认隐式提示',
-            'implicit_prompt': '请以专业、准确和有用的方式回答问题。'
+    def _default_sections(self) -> Sections:
+        """Contents of a newly created configuration file"""
+        return {
+            'default': {
+                'name': '默认隐式提示',
+                'implicit_prompt': '请以专业、准确和有用的方式回答问题。'
+            },
+            'normal': {
+                'name': '标准对话隐式提示',
+                'implicit_prompt': '请提供清晰、准确的回答，如果不确定请说明。'
+            },
+            'search': {
+                'name': '搜索模式隐式提示',
+                'implicit_prompt': '请基于搜索到的最新信息提供准确回答，并在可能的情况下提供相关链接。'
+            },
+            'nosystem': {
+                'name': '自由对话隐式提示',
+                'implicit_prompt': '请自然地回答用户问题，保持对话的连贯性。'
+            }
         }
-        
-        self.config['normal'] = {
-            'name': '标准对话隐式提示',
-            'implicit_prompt': '请提供清晰、准确的回答，如果不确定请说明。'
-        }
-        
-        self.config['search'] = {
-            'name': '搜索模式隐式提示',
-            'implicit_prompt': '请基于搜索到的最新信息提供准确回答，并在可能的情况下提供相关链接。'
-        }
-        
-        self.config['nosystem'] = {
-            'name': '自由对话隐式提示',
-            'implicit_prompt': '请自然地回答用户问题，保持对话的连贯性。'
+
+    def _compile(self, sections: Mapping[str, Mapping[str, str]]) -> Dict[str, Any]:
+        default = sections.get('default', {})
+        return {
+            "prompts": {name: section.get('implicit_prompt', '') for name, section in sections.items()},
+            "default_prompt": default.get('implicit_prompt', ''),
+            "names": {name: section.get('name', name) for name, section in sections.items()},
+            "default_name": default.get('name', 'Default')
         }
-        
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            self.config.write(f)
 
     def get_implicit_prompt(self, mode: str = "default") -> str:
         """Get implicit prompt by mode"""
-        if mode in self.config:
-            return self.config[mode].get('implicit_prompt', '')
-        return self.config['default'].get('implicit_prompt', '')
+        tables = self._tables
+        return tables["prompts"].get(mode, tables["default_prompt"])
 
     def get_prompt_name(self, mode: str = "default") -> str:
         """Get implicit prompt name by mode"""
-        if mode in self.config:
-            return self.config[mode].get('name', mode)
-        return self.config['default'].get('name', 'Default')
+        tables = self._tables
+        return tables["names"].get(mode, tables["default_name"])
 
     def set_implicit_prompt(self, mode: str, name: str, implicit_prompt: str):
         """Set implicit prompt for a mode"""
-        self.config[mode] = {
+        self._set_section(mode, {
             'name': name,
             'implicit_prompt': implicit_prompt
-        }
-        
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            self.config.write(f)
+        })
+
+
+class ConfigWatcher:
+    """Polls the config files' mtimes in a daemon thread and reloads the ones that changed"""
+
+    def __init__(self, managers: Iterable[_IniConfig], interval: float = 2.0):
+        self.managers = list(managers)
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def check(self) -> int:
+        """Reload changed files now; returns how many were reloaded"""
+        reloaded = 0
+        for manager in self.managers:
+            try:
+                if manager.reload():
+                    print(f"🔄 已重新加载配置 {manager.config_file}")
+                    reloaded += 1
+            except Exception as e:
+                print(f"⚠️  重新加载配置失败 {manager.config_file}: {e}")
+        return reloaded
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="config-watcher", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
@@ -0,0 +1,134 @@
+"""
+上下文构建 - 按token预算打包对话历史
+"""
+
+import os
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from .models import Message
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken是可选依赖，缺失时使用估算
+    tiktoken = None
+
+
+@lru_cache(maxsize=8)
+def _get_encoding(model: str):
+    """tiktoken encoding for a model, or None if tiktoken is unavailable"""
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        # 编码文件需要联网下载，失败时退回估算
+        print(f"⚠️  无法加载tiktoken编码，使用估算token数: {e}")
+        return None
+
+
+def _is_cjk(char: str) -> bool:
+    return '⺀' <= char <= '鿿' or '가' <= char <= '힯' or '＀' <= char <= '￯'
+
+
+def count_tokens(text: str, model: str = "gpt-4o") -> int:
+    """Count tokens with tiktoken, or estimate them when it is not installed"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    # 估算：CJK字符约1个token，其他字符约4个字符1个token
+    cjk = sum(1 for char in text if _is_cjk(char))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-4o") -> str:
+    """Cut text down to at most max_tokens tokens"""
+    encoding = _get_encoding(model)
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        if len(tokens) <= max_tokens:
+            return text
+        return encoding.decode(tokens[:max_tokens]) + "…"
+
+    total = count_tokens(text, model)
+    if total <= max_tokens:
+        return text
+    end = max(1, len(text) * max_tokens // total)
+    while end > 1 and count_tokens(text[:end], model) > max_tokens:
+        end = end * 9 // 10
+    return text[:end] + "…"
+
+
+@lru_cache(maxsize=256)
+def _cached_count(text: str, model: str) -> int:
+    # 用于重复出现的同一前缀字符串；str会缓存自身的hash，命中时无需重新计数
+    return count_tokens(text, model)
+
+
+def message_tokens(message: Message, model: str = "gpt-4o") -> int:
+    """Token count of a message, cached on the message"""
+    if message.token_count is None:
+        message.token_count = count_tokens(message.content, model)
+    return message.token_count
+
+
+class ContextBuilder:
+    """Packs conversation history into a token budget, newest turns first"""
+
+    def __init__(self, max_tokens: int = 4000, max_message_tokens: int = 1000, model: str = "gpt-4o"):
+        self.max_tokens = max_tokens
+        self.max_message_tokens = max_message_tokens
+        self.model = model
+
+    @classmethod
+    def from_env(cls) -> 'ContextBuilder':
+        """Build a context builder from CONTEXT_* environment variables"""
+        return cls(
+            max_tokens=int(os.getenv("CONTEXT_MAX_TOKENS", 4000)),
+            max_message_tokens=int(os.getenv("CONTEXT_MAX_MESSAGE_TOKENS", 1000))
+        )
+
+    def select(self, messages: List[Message], budget: Optional[int] = None,
+               start: int = 0, end: Optional[int] = None) -> List[Tuple[Message, str]]:
+        """Pick the newest user/assistant messages in messages[start:end] that fit the budget.
+
+        Returns (message, content) pairs in chronological order; content is
+        truncated for messages longer than max_message_tokens. Only the
+        selected window is visited, so the history is never copied.
+        """
+        budget = self.max_tokens if budget is None else budget
+        end = len(messages) if end is None else min(end, len(messages))
+        if end < 0:
+            end += len(messages)
+        selected = []
+        used = 0
+        for index in range(end - 1, start - 1, -1):
+            message = messages[index]
+            if message.role not in ("user", "assistant"):
+                continue
+            tokens = message_tokens(message, self.model)
+            content = message.content
+            if tokens > self.max_message_tokens:
+                content = truncate_to_tokens(content, self.max_message_tokens, self.model)
+                tokens = self.max_message_tokens
+            if used + tokens > budget:
+                break
+            selected.append((message, content))
+            used += tokens
+        selected.reverse()
+        return selected
+
+    def history_budget(self, *fixed_parts: str) -> int:
+        """Budget left for history after the system prompt and current message"""
+        fixed = sum(count_tokens(part, self.model) for part in fixed_parts)
+        return max(0, self.max_tokens - fixed)
+
+    def prefix_budget(self, prefix: str, current_message: str) -> int:
+        """history_budget() for a cached context prefix, counting the prefix only once"""
+        fixed = _cached_count(prefix, self.model) + count_tokens(current_message, self.model)
+        return max(0, self.max_tokens - fixed)
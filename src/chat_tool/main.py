@@ -1,16 +1,20 @@
 from fastapi import FastAPI, HTTPException, Request, Form
-from fastapi.responses import HTMLResponse, FileResponse, Response
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import HTMLResponse, FileResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
 import os
 import uuid
 import json
+import asyncio
 from datetime import datetime
 from typing import Dict, List, Optional
 from dotenv import load_dotenv
 
 from .openai_service import OpenAIService
+from .client_factory import close_client_factories
+from .config_manager import ConfigWatcher
+from .static_assets import AssetManifest, PrecompressedStaticFiles, build_assets
+from .prerender import PrerenderedPages
 from .models import ChatMode
 
 # Load environment variables first
@@ -18,9 +22,18 @@ load_dotenv()
 
 app = FastAPI(title="Chat Tool API", version="1.0.0")
 
+# 构建带内容哈希的静态资源 (static/dist)，模板通过asset_url引用
+try:
+    assets = AssetManifest(build_assets("static"))
+except OSError as e:
+    print(f"⚠️  构建静态资源失败，使用未哈希的文件: {e}")
+    assets = AssetManifest({})
+
 # Setup static files and templates
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
 templates = Jinja2Templates(directory="templates")
+templates.env.globals["asset_url"] = assets.url
+pages = PrerenderedPages(templates.env)
 
 # Initialize OpenAI service with error handling
 def create_openai_service():
@@ -37,6 +50,64 @@ def create_openai_service():
 
 openai_service = create_openai_service()
 
+async def collect_empty_sessions_periodically():
+    """定期清理从未发送过消息的空会话"""
+    interval = float(os.getenv("EMPTY_SESSION_GC_INTERVAL", 600))
+    max_age = float(os.getenv("EMPTY_SESSION_TTL", 3600))
+    while True:
+        # 先等待一个周期，启动时不扫描全部会话
+        await asyncio.sleep(interval)
+        try:
+            removed = await openai_service.collect_empty_sessions(max_age)
+            if removed:
+                print(f"🧹 已清理 {removed} 个空会话")
+        except Exception as e:
+            print(f"⚠️  清理空会话失败: {e}")
+
+@app.on_event("startup")
+async def start_empty_session_gc():
+    """启动空会话清理任务"""
+    if openai_service is not None:
+        app.state.empty_session_gc = asyncio.create_task(collect_empty_sessions_periodically())
+
+@app.on_event("startup")
+async def reconcile_assistants():
+    """启动时清理遗留的孤立Assistant"""
+    if openai_service is None:
+        return
+    try:
+        deleted = await openai_service.reconcile_assistants()
+        if deleted:
+            print(f"🧹 已清理 {deleted} 个孤立的Assistant")
+    except Exception as e:
+        print(f"⚠️  清理Assistant失败: {e}")
+
+@app.on_event("startup")
+async def start_config_watcher():
+    """启动配置文件热加载，修改prompt和欢迎语无需重启"""
+    interval = float(os.getenv("CONFIG_RELOAD_INTERVAL", 2))
+    if openai_service is None or interval <= 0:
+        return
+    app.state.config_watcher = ConfigWatcher([
+        openai_service.prompt_manager,
+        openai_service.welcome_manager,
+        openai_service.implicit_prompt_manager
+    ], interval)
+    app.state.config_watcher.start()
+
+@app.on_event("shutdown")
+async def shutdown_service():
+    """停止后台任务并关闭共享的OpenAI连接池"""
+    gc_task = getattr(app.state, "empty_session_gc", None)
+    if gc_task is not None:
+        gc_task.cancel()
+    config_watcher = getattr(app.state, "config_watcher", None)
+    if config_watcher is not None:
+        config_watcher.stop()
+    await close_client_factories()
+    if openai_service is not None:
+        openai_service.session_manager.close()
+
 # Pydantic models for API
 class CreateSessionRequest(BaseModel):
     prompt_type: str = "default"
@@ -44,6 +115,14 @@ class CreateSessionRequest(BaseModel):
 
 class SendMessageRequest(BaseModel):
     message: str
+    # 页面懒创建的会话在首条消息时携带以下字段完成创建
+    prompt_type: Optional[str] = None
+    mode: Optional[str] = None
+
+    def chat_mode(self) -> Optional[ChatMode]:
+        if self.mode is None:
+            return None
+        return ChatMode.SEARCH if self.mode == "search" else ChatMode.NORMAL
 
 class SessionResponse(BaseModel):
     session_id: str
@@ -73,11 +152,13 @@ async def favicon():
 @app.get("/health")
 async def health_check():
     """健康检查端点"""
+    breakers = openai_service.get_breaker_states() if openai_service else {}
     return {
-        "status": "healthy",
+        "status": "degraded" if "open" in breakers.values() else "healthy",
         "service": "Chat Tool API",
         "timestamp": datetime.now().isoformat(),
-        "openai_service": "available" if openai_service else "unavailable"
+        "openai_service": "available" if openai_service else "unavailable",
+        "circuit_breakers": breakers
     }
 
 # 直接对话接口 - 三个固定链接
@@ -105,6 +186,13 @@ async def create_interface_session(request: Request, prompt_type: str, mode: str
             "error": "OpenAI服务未配置，请检查API密钥设置"
         })
     
+    if openai_service.is_degraded(prompt_type):
+        # 上游模型不可用且没有备用模型时，直接返回降级页面
+        return templates.TemplateResponse("error.html", {
+            "request": request,
+            "error": "AI服务暂时不可用，请稍后再试"
+        }, status_code=503)
+    
     try:
         # 自动创建会话
         import uuid
@@ -116,25 +204,29 @@ async def create_interface_session(request: Request, prompt_type: str, mode: str
         else:
             chat_mode = ChatMode.NORMAL
         
+        # 懒创建：首条消息发送时才创建线程并写入会话文件
         session = await openai_service.create_chat_session(
             user_id=user_id,
             prompt_type=prompt_type,
-            mode=chat_mode
+            mode=chat_mode,
+            lazy=True
         )
         
         # 获取欢迎消息 - 使用正确的模式名称
         welcome_mode = mode if mode in ["normal", "search", "nosystem"] else "normal"
         welcome_data = openai_service.get_welcome_message(welcome_mode)
         
-        return templates.TemplateResponse("chat_interface.html", {
-            "request": request,
-            "session": session,
-            "interface_name": interface_name,
-            "mode": mode,
-            "history": [],
-            "welcome_title": welcome_data['title'],
-            "welcome_message": welcome_data['message']
-        })
+        # 页面只在界面或欢迎语变化时渲染一次，之后每次请求仅替换会话ID
+        return HTMLResponse(pages.render(
+            "chat_interface.html",
+            session.session_id,
+            interface_name=interface_name,
+            mode=mode,
+            prompt_type=prompt_type,
+            history=(),
+            welcome_title=welcome_data['title'],
+            welcome_message=welcome_data['message']
+        ))
         
     except Exception as e:
         return templates.TemplateResponse("error.html", {
@@ -195,7 +287,12 @@ async def send_message(session_id: str, request: SendMessageRequest):
     """Send a message in a chat session"""
     check_service()
     try:
-        result = await openai_service.send_message(session_id, request.message)
+        result = await openai_service.send_message(
+            session_id,
+            request.message,
+            prompt_type=request.prompt_type,
+            mode=request.chat_mode()
+        )
         
         return MessageResponse(
             success=result["success"],
@@ -211,6 +308,29 @@ async def send_message(session_id: str, request: SendMessageRequest):
             session_id=session_id
         )
 
+@app.post("/api/sessions/{session_id}/messages/stream")
+async def stream_message(session_id: str, request: SendMessageRequest):
+    """Send a message and stream the reply as Server-Sent Events"""
+    check_service()
+
+    async def event_stream():
+        async for event in openai_service.stream_message(
+            session_id,
+            request.message,
+            prompt_type=request.prompt_type,
+            mode=request.chat_mode()
+        ):
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no"
+        }
+    )
+
 @app.get("/api/sessions/{session_id}")
 async def get_session(session_id: str):
     """Get session information"""
@@ -223,7 +343,8 @@ async def get_session(session_id: str):
         "user_id": session.user_id,
         "mode": session.mode.value,
         "created_at": session.created_at.isoformat(),
-        "updated_at": session.updated_at.isoformat()
+        "updated_at": session.updated_at.isoformat(),
+        "queued_messages": openai_service.get_queue_depth(session_id)
     }
 
 @app.post("/api/sessions/{session_id}/export")
@@ -231,19 +352,11 @@ async def export_conversation(session_id: str):
     """Export conversation to JSON file"""
     check_service()
     
-    # 直接从data/sessions目录读取现有的会话文件
-    sessions_dir = os.path.join(os.getcwd(), "data", "sessions")
-    session_file = os.path.join(sessions_dir, f"{session_id}.json")
-    
-    if not os.path.exists(session_file):
+    session = openai_service.get_session(session_id)
+    if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    # 读取现有会话数据
-    try:
-        with open(session_file, 'r', encoding='utf-8') as f:
-            session_data = json.load(f)
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Failed to read session data: {str(e)}")
+    session_data = session.to_dict()
     
     # 创建导出数据（添加导出时间戳）
     export_data = {
@@ -307,6 +420,12 @@ async def delete_session(session_id: str):
     
     return {"message": "Session deleted successfully"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """Runtime metrics (session locks, cache usage)"""
+    check_service()
+    return openai_service.get_metrics()
+
 @app.get("/api/prompts")
 async def get_available_prompts():
     """Get available system prompts"""
@@ -0,0 +1,146 @@
+"""
+模型路由 - 按prompt类型配置模型，简单问题使用更快的小模型，并统计各模型的延迟与成本
+"""
+
+import os
+import re
+from dataclasses import dataclass
+from typing import Any, Dict, Optional, Tuple
+
+from .context_builder import count_tokens
+from .models import ChatSession
+from .resilience import LatencyTracker
+
+# 每百万token的美元价格 (输入, 输出)，可通过MODEL_PRICES覆盖
+DEFAULT_PRICES: Dict[str, Tuple[float, float]] = {
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+}
+
+# 出现这些特征时视为复杂问题，始终使用主模型
+_COMPLEX_PATTERN = re.compile(
+    r"```|代码|分析|详细|步骤|比较|对比|解释|为什么|原理|推导|计划|方案|"
+    r"\b(code|explain|analy[sz]e|compare|step|why|debug|implement|design|plan)",
+    re.IGNORECASE
+)
+
+
+@dataclass
+class Route:
+    model: str
+    fallback_model: Optional[str] = None
+    reason: str = "default"
+
+
+def is_simple_turn(message: str, max_tokens: int) -> bool:
+    """Short, single-line questions without signs of a complex task"""
+    return (count_tokens(message) <= max_tokens
+            and message.count("\n") < 3
+            and not _COMPLEX_PATTERN.search(message))
+
+
+class _ModelStats:
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cached_tokens = 0
+        self.cost = 0.0
+        self.latency = LatencyTracker()
+
+
+class ModelRouter:
+    """Chooses the model for each turn from the prompt type's route options.
+
+    ``system_prompts.ini`` sections may set ``model``, ``fast_model``,
+    ``fast_max_tokens`` and ``fallback_model``; turns that look simple go to
+    ``fast_model`` when one is configured.
+    """
+
+    def __init__(self, prompt_manager, default_model: str = "gpt-4o",
+                 default_fallback: Optional[str] = None, fast_max_tokens: int = 60,
+                 prices: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.prompt_manager = prompt_manager
+        self.default_model = default_model
+        self.default_fallback = default_fallback
+        self.fast_max_tokens = fast_max_tokens
+        self.prices = dict(DEFAULT_PRICES, **(prices or {}))
+        self._stats: Dict[str, _ModelStats] = {}
+
+    @classmethod
+    def from_env(cls, prompt_manager) -> 'ModelRouter':
+        """Build a router from MODEL_* / FALLBACK_MODEL environment variables.
+
+        MODEL_PRICES overrides prices per model, e.g. "gpt-4o:2.5:10" (input:output
+        USD per million tokens).
+        """
+        prices = {}
+        for item in os.getenv("MODEL_PRICES", "").split(","):
+            if item.strip():
+                model, input_price, output_price = item.strip().split(":")
+                prices[model] = (float(input_price), float(output_price))
+        return cls(
+            prompt_manager,
+            default_model=os.getenv("MODEL_DEFAULT", "gpt-4o"),
+            default_fallback=os.getenv("FALLBACK_MODEL") or None,
+            fast_max_tokens=int(os.getenv("MODEL_FAST_MAX_TOKENS", 60)),
+            prices=prices
+        )
+
+    def base_route(self, prompt_type: str) -> Route:
+        """The main model and fallback configured for a prompt type"""
+        options = self.prompt_manager.get_route_options(prompt_type)
+        model = options.get("model") or self.default_model
+        fallback = options.get("fallback_model") or self.default_fallback
+        return Route(model, fallback if fallback != model else None)
+
+    def route(self, session: ChatSession, user_message: str) -> Route:
+        """Pick the model for this turn"""
+        route = self.base_route(session.prompt_type)
+        options = self.prompt_manager.get_route_options(session.prompt_type)
+        fast_model = options.get("fast_model")
+        max_tokens = int(options.get("fast_max_tokens") or self.fast_max_tokens)
+        if fast_model and fast_model != route.model and is_simple_turn(user_message, max_tokens):
+            # 小模型在输出内容前因上游故障失败时，OpenAIService用主模型重试这一轮
+            return Route(fast_model, route.model, reason="simple")
+        return route
+
+    def _model_stats(self, model: str) -> _ModelStats:
+        stats = self._stats.get(model)
+        if stats is None:
+            stats = self._stats[model] = _ModelStats()
+        return stats
+
+    def record(self, model: str, latency: float, input_tokens: Optional[int] = None,
+               output_tokens: Optional[int] = None, cached_tokens: Optional[int] = None):
+        """Record a completed call; cached_tokens are the input tokens served from the prompt cache"""
+        stats = self._model_stats(model)
+        stats.calls += 1
+        stats.latency.record(latency)
+        stats.input_tokens += input_tokens or 0
+        stats.output_tokens += output_tokens or 0
+        stats.cached_tokens += cached_tokens or 0
+        input_price, output_price = self.prices.get(model, (0.0, 0.0))
+        stats.cost += ((input_tokens or 0) * input_price + (output_tokens or 0) * output_price) / 1_000_000
+
+    def record_error(self, model: str):
+        self._model_stats(model).errors += 1
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Calls, errors, latency percentiles, tokens, prompt cache hit ratio and estimated cost per model"""
+        return {
+            model: {
+                "calls": stats.calls,
+                "errors": stats.errors,
+                "latency_p50": stats.latency.quantile(0.5),
+                "latency_p95": stats.latency.quantile(0.95),
+                "input_tokens": stats.input_tokens,
+                "output_tokens": stats.output_tokens,
+                "cached_tokens": stats.cached_tokens,
+                "cached_ratio": round(stats.cached_tokens / stats.input_tokens, 3) if stats.input_tokens else None,
+                "cost_usd": round(stats.cost, 6),
+                "cost_per_call_usd": round(stats.cost / stats.calls, 6) if stats.calls else None
+            }
+            for model, stats in self._stats.items()
+        }
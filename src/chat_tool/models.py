@@ -1,8 +1,9 @@
-from typing import Dict, List, Optional, Any
+from typing import Dict, List, Optional, Any, Tuple
+from collections import OrderedDict
 from datetime import datetime
-import json
 import os
-from dataclasses import dataclass, asdict
+import sys
+from dataclasses import dataclass, asdict, field
 from enum import Enum
 
 class ChatMode(Enum):
@@ -15,6 +16,8 @@ class Message:
     content: str
     timestamp: datetime
     message_id: str
+    # 缓存的token数，避免每轮重复计算
+    token_count: Optional[int] = field(default=None, repr=False, compare=False)
 
     def to_dict(self) -> Dict[str, Any]:
         return {
@@ -44,6 +47,9 @@ class ChatSession:
     messages: List[Message] = None
     created_at: datetime = None
     updated_at: datetime = None
+    summary: str = ""  # Running summary of older turns
+    summary_message_count: int = 0  # Number of leading messages folded into summary
+    previous_response_id: Optional[str] = None  # Last stored response of the search-mode chain
 
     def __post_init__(self):
         if self.messages is None:
@@ -57,6 +63,16 @@ class ChatSession:
         self.messages.append(message)
         self.updated_at = datetime.now()
 
+    def remove_message(self, message_id: str) -> bool:
+        """Remove a message, e.g. a user message whose turn failed"""
+        for index in range(len(self.messages) - 1, -1, -1):
+            if self.messages[index].message_id == message_id:
+                del self.messages[index]
+                if index < self.summary_message_count:
+                    self.summary_message_count -= 1
+                return True
+        return False
+
     def get_messages_for_api(self) -> List[Dict[str, str]]:
         """Get messages in format suitable for OpenAI API"""
         api_messages = []
@@ -68,8 +84,15 @@ class ChatSession:
                 "content": self.system_prompt
             })
         
+        # Add running summary in place of the turns it covers
+        if self.summary:
+            api_messages.append({
+                "role": "system",
+                "content": f"对话摘要: {self.summary}"
+            })
+        
         # Add conversation messages
-        for msg in self.messages:
+        for msg in self.messages[self.summary_message_count:]:
             if msg.role in ["user", "assistant"]:
                 api_messages.append({
                     "role": msg.role,
@@ -78,7 +101,8 @@ class ChatSession:
         
         return api_messages
 
-    def to_dict(self) -> Dict[str, Any]:
+    def header_dict(self) -> Dict[str, Any]:
+        """Session fields without the message list"""
         return {
             "session_id": self.session_id,
             "user_id": self.user_id,
@@ -86,11 +110,18 @@ class ChatSession:
             "system_prompt": self.system_prompt,
             "prompt_type": self.prompt_type,
             "thread_id": self.thread_id,
-            "messages": [msg.to_dict() for msg in self.messages],
+            "summary": self.summary,
+            "summary_message_count": self.summary_message_count,
+            "previous_response_id": self.previous_response_id,
             "created_at": self.created_at.isoformat(),
             "updated_at": self.updated_at.isoformat()
         }
 
+    def to_dict(self) -> Dict[str, Any]:
+        data = self.header_dict()
+        data["messages"] = [msg.to_dict() for msg in self.messages]
+        return data
+
     @classmethod
     def from_dict(cls, data: Dict[str, Any]) -> 'ChatSession':
         messages = [Message.from_dict(msg_data) for msg_data in data.get("messages", [])]
@@ -103,40 +134,104 @@ class ChatSession:
             thread_id=data.get("thread_id"),
             messages=messages,
             created_at=datetime.fromisoformat(data["created_at"]),
-            updated_at=datetime.fromisoformat(data["updated_at"])
+            updated_at=datetime.fromisoformat(data["updated_at"]),
+            summary=data.get("summary", ""),
+            summary_message_count=data.get("summary_message_count", 0),
+            previous_response_id=data.get("previous_response_id")
         )
 
+# storage依赖上面定义的模型类，因此在这里导入
+from .storage import SessionConflictError, SessionStore, create_session_store
+
+
 class SessionManager:
-    def __init__(self, storage_dir: str = "data/sessions"):
+    """Session access with on-demand loading and a bounded LRU cache.
+
+    Sessions are loaded from the store on first access, so startup cost does not
+    depend on how much history is stored. The cache is bounded both by session
+    count and by an estimate of memory use; least recently used sessions are
+    flushed to the store and evicted when either limit is exceeded.
+    """
+
+    def __init__(self, storage_dir: str = "data/sessions", store: Optional[SessionStore] = None,
+                 max_cached_sessions: Optional[int] = None, max_cache_bytes: Optional[int] = None,
+                 shared: Optional[bool] = None):
         self.storage_dir = storage_dir
-        os.makedirs(storage_dir, exist_ok=True)
-        self._sessions: Dict[str, ChatSession] = {}
-        self._load_sessions()
+        self._store = store or create_session_store(storage_dir)
+        # 多worker共享存储时，命中缓存前先校验存储中的版本，其他worker更新过则重新加载
+        if shared is None:
+            shared = os.getenv("SESSION_SHARED", "False").lower() == "true"
+        if shared and not self._store.multiprocess_safe:
+            # jsonl日志的追加写入没有跨进程的冲突检测，多个worker会交错写入同一会话
+            raise ValueError(
+                f"SESSION_SHARED requires a multi-process safe store (SESSION_BACKEND=sqlite), "
+                f"got {type(self._store).__name__}"
+            )
+        self.shared = shared
+        self._versions: Dict[str, Any] = {}
+        self.max_cached_sessions = max_cached_sessions or int(os.getenv("SESSION_CACHE_SIZE", 1000))
+        self.max_cache_bytes = max_cache_bytes or int(os.getenv("SESSION_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+        self._sessions: "OrderedDict[str, ChatSession]" = OrderedDict()
+        # session_id -> (已计入的消息数, 估算字节数)
+        self._sizes: Dict[str, Tuple[int, int]] = {}
+        self._cache_bytes = 0
 
-    def _get_session_file(self, session_id: str) -> str:
-        return os.path.join(self.storage_dir, f"{session_id}.json")
+    @staticmethod
+    def _estimate_message_bytes(messages: List[Message]) -> int:
+        return sum(sys.getsizeof(msg.content) + 256 for msg in messages)
 
-    def _load_sessions(self):
-        """Load all sessions from storage"""
-        if not os.path.exists(self.storage_dir):
-            return
-        
-        for filename in os.listdir(self.storage_dir):
-            if filename.endswith(".json"):
-                session_id = filename[:-5]  # Remove .json extension
-                try:
-                    with open(os.path.join(self.storage_dir, filename), 'r', encoding='utf-8') as f:
-                        data = json.load(f)
-                        session = ChatSession.from_dict(data)
-                        self._sessions[session_id] = session
-                except Exception as e:
-                    print(f"Error loading session {session_id}: {e}")
+    def _cache_put(self, session: ChatSession):
+        """Insert or refresh a session in the cache, then enforce the limits"""
+        session_id = session.session_id
+        self._sessions[session_id] = session
+        self._sessions.move_to_end(session_id)
+
+        base_size = sys.getsizeof(session.system_prompt) + 1024
+        counted, old_size = self._sizes.get(session_id, (0, 0))
+        if session_id not in self._sizes or len(session.messages) < counted:
+            counted, size = 0, base_size
+        else:
+            size = old_size
+        new_size = size + self._estimate_message_bytes(session.messages[counted:])
+        self._cache_bytes += new_size - old_size
+        self._sizes[session_id] = (len(session.messages), new_size)
+
+        self._evict()
+
+    def _cache_drop(self, session_id: str) -> Optional[ChatSession]:
+        session = self._sessions.pop(session_id, None)
+        self._versions.pop(session_id, None)
+        _, size = self._sizes.pop(session_id, (0, 0))
+        self._cache_bytes -= size
+        return session
+
+    def _evict(self):
+        """Flush and evict least recently used sessions until within limits"""
+        while len(self._sessions) > 1 and (
+            len(self._sessions) > self.max_cached_sessions or self._cache_bytes > self.max_cache_bytes
+        ):
+            session_id = next(iter(self._sessions))
+            session = self._sessions[session_id]
+            try:
+                self._save_session(session)
+            except Exception as e:
+                print(f"Error flushing session {session_id}: {e}")
+                return
+            self._cache_drop(session_id)
+
+    def cache_info(self) -> Dict[str, int]:
+        """Current cache occupancy"""
+        return {
+            "cached_sessions": len(self._sessions),
+            "cached_bytes": self._cache_bytes,
+            "max_cached_sessions": self.max_cached_sessions,
+            "max_cache_bytes": self.max_cache_bytes,
+            "shared": self.shared
+        }
 
     def _save_session(self, session: ChatSession):
         """Save session to storage"""
-        session_file = self._get_session_file(session.session_id)
-        with open(session_file, 'w', encoding='utf-8') as f:
-            json.dump(session.to_dict(), f, indent=2, ensure_ascii=False)
+        self._store.save(session)
 
     def create_session(self, session_id: str, user_id: str, mode: ChatMode, 
                       system_prompt: str, prompt_type: str = "default", 
@@ -150,30 +245,93 @@ class SessionManager:
             prompt_type=prompt_type,
             thread_id=thread_id
         )
-        self._sessions[session_id] = session
         self._save_session(session)
+        self._remember_version(session_id)
+        self._cache_put(session)
         return session
 
     def get_session(self, session_id: str) -> Optional[ChatSession]:
-        """Get session by ID"""
-        return self._sessions.get(session_id)
+        """Get session by ID, loading it from storage on first access"""
+        session = self._sessions.get(session_id)
+        if session is not None:
+            if not self.shared or self._store.version(session_id) == self._versions.get(session_id):
+                self._sessions.move_to_end(session_id)
+                return session
+            # 其他worker已修改或删除该会话，丢弃缓存副本
+            self._cache_drop(session_id)
+
+        try:
+            session = self._store.load(session_id)
+        except Exception as e:
+            print(f"Error loading session {session_id}: {e}")
+            return None
+        if session is not None:
+            self._remember_version(session_id)
+            self._cache_put(session)
+        return session
+
+    def _remember_version(self, session_id: str):
+        if self.shared:
+            self._versions[session_id] = self._store.version(session_id)
 
     def update_session(self, session: ChatSession):
-        """Update session and save to storage"""
+        """Update session and save to storage.
+
+        Raises SessionConflictError if another worker changed the stored session
+        first; the stale cached copy is dropped so the next access reloads it.
+        """
         session.updated_at = datetime.now()
-        self._sessions[session.session_id] = session
-        self._save_session(session)
+        try:
+            self._save_session(session)
+        except SessionConflictError:
+            self._cache_drop(session.session_id)
+            raise
+        self._remember_version(session.session_id)
+        self._cache_put(session)
 
     def delete_session(self, session_id: str) -> bool:
         """Delete session"""
-        if session_id in self._sessions:
-            del self._sessions[session_id]
-            session_file = self._get_session_file(session_id)
-            if os.path.exists(session_file):
-                os.remove(session_file)
-            return True
-        return False
+        cached = self._cache_drop(session_id) is not None
+        return self._store.delete(session_id) or cached
+
+    def find_empty_sessions(self, max_age_seconds: float) -> List[str]:
+        """Ids of stored sessions without messages that are older than max_age_seconds.
+
+        Only reads the storage backend, so it may run in a worker thread.
+        """
+        cutoff = datetime.fromtimestamp(datetime.now().timestamp() - max_age_seconds)
+        return self._store.list_empty_session_ids(cutoff)
+
+    def collect_empty_sessions(self, max_age_seconds: float, candidates: Optional[List[str]] = None) -> int:
+        """Delete sessions without messages that are older than max_age_seconds.
+
+        ``candidates`` from an earlier find_empty_sessions() call are checked again
+        first, since a message may have arrived after the scan.
+        """
+        if candidates is None:
+            candidates = self.find_empty_sessions(max_age_seconds)
+        cutoff = datetime.fromtimestamp(datetime.now().timestamp() - max_age_seconds)
+        removed = 0
+        for session_id in candidates:
+            session = self._sessions.get(session_id) or self._store.load(session_id)
+            if session is None or session.messages or session.updated_at >= cutoff:
+                continue
+            self._cache_drop(session_id)
+            self._store.delete(session_id)
+            removed += 1
+        return removed
 
     def get_user_sessions(self, user_id: str) -> List[ChatSession]:
-        """Get all sessions for a user"""
-        return [session for session in self._sessions.values() if session.user_id == user_id]
+        """Get all sessions for a user, most recently updated first"""
+        sessions = [self.get_session(session_id) for session_id in self._store.list_user_session_ids(user_id)]
+        return [session for session in sessions if session]
+
+    def get_sessions_updated_between(self, start: datetime, end: datetime) -> List[ChatSession]:
+        """Get sessions updated within [start, end)"""
+        sessions = [self.get_session(session_id)
+                    for session_id in self._store.list_session_ids_updated_between(start, end)]
+        return [session for session in sessions if session]
+
+    def close(self):
+        """Close the storage backend"""
+        self._store.close()
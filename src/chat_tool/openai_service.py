@@ -1,16 +1,80 @@
 import os
+import time
 import uuid
-from typing import List, Dict, Optional, Any
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, List, Dict, Optional, Any
 from datetime import datetime
-from openai import OpenAI
+from openai import NOT_GIVEN, BadRequestError, NotFoundError
 from .models import ChatSession, Message, ChatMode, SessionManager
 from .config_manager import SystemPromptManager, WelcomeMessageManager, ImplicitPromptManager
+from .run_waiter import RunResult, RunWaiter
+from .assistant_registry import AssistantRegistry
+from .session_locks import SessionHold, SessionLocks
+from .context_builder import ContextBuilder, count_tokens, message_tokens
+from .summarizer import ConversationSummarizer
+from .response_cache import ResponseCache, conversation_scope, normalize_question
+from .coalescing import SingleFlight
+from .client_factory import get_client_factory
+from .rate_limiter import ASSISTANTS_LANE, Priority, get_rate_limiter
+from .resilience import Hedger, RetryPolicy
+from .circuit_breaker import OPEN, CircuitBreaker, is_upstream_failure
+from .model_router import ModelRouter
+from .prompt_assembly import SEARCH_INSTRUCTIONS, PromptAssembler, cached_tokens
+
+DEGRADED_MESSAGE = "AI服务暂时不可用，请稍后再试"
+
+async def _prepend(first, events: AsyncIterator) -> AsyncIterator:
+    """Yield an already received first event, then the rest of the stream"""
+    if first is not None:
+        yield first
+        async for event in events:
+            yield event
+
+async def _response_text(events: AsyncIterator, state: RunResult) -> AsyncIterator[str]:
+    """Yield text deltas of a responses stream; the completed response is recorded on state"""
+    async for event in events:
+        if event.type == 'response.output_text.delta':
+            yield event.delta
+        elif event.type == 'response.completed':
+            state.run = event.response
+            state.text = event.response.output_text
+        elif event.type in ('response.failed', 'response.incomplete'):
+            raise RuntimeError(f"Response {event.type.split('.')[-1]}")
+        elif event.type == 'error':
+            raise RuntimeError(event.message)
+
+async def _close_stream(opened):
+    """Close the stream of a hedged request that lost"""
+    await opened[0].close()
+
+def _usage_split(result) -> Dict[str, Any]:
+    """Input/output/cached token counts of a run (prompt/completion) or response (input/output)"""
+    usage = getattr(result, "usage", None)
+    counts = {
+        "input_tokens": getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", None),
+        "output_tokens": getattr(usage, "output_tokens", None) or getattr(usage, "completion_tokens", None),
+        "cached_tokens": cached_tokens(usage)
+    }
+    counts = {key: value for key, value in counts.items() if isinstance(value, int)}
+    if counts.get("input_tokens") and "cached_tokens" in counts:
+        counts["cached_ratio"] = round(counts["cached_tokens"] / counts["input_tokens"], 3)
+    return counts
+
+def _is_chain_error(error: Exception) -> bool:
+    """Whether a request failed because previous_response_id no longer resolves"""
+    return getattr(error, "param", None) == "previous_response_id" or "previous_response_id" in str(error)
+
+def _usage_tokens(result) -> Optional[int]:
+    """Total tokens reported on a run or response, if any"""
+    total = getattr(getattr(result, "usage", None), "total_tokens", None)
+    return total if isinstance(total, int) else None
 
 class OpenAIService:
     def __init__(self, api_key: str):
-        # 最简单的OpenAI客户端初始化方式
+        # 使用异步客户端，避免上游请求阻塞事件循环；连接池由进程内所有组件共享
         try:
-            self.client = OpenAI(api_key=api_key)
+            self.client_factory = get_client_factory(api_key)
+            self.client = self.client_factory.async_client()
             print("✅ OpenAI客户端初始化成功")
         except Exception as e:
             print(f"❌ OpenAI客户端初始化失败: {e}")
@@ -20,32 +84,96 @@ class OpenAIService:
         self.prompt_manager = SystemPromptManager()
         self.welcome_manager = WelcomeMessageManager()
         self.implicit_prompt_manager = ImplicitPromptManager()
+        self.run_waiter = RunWaiter.from_env()
+        self.session_locks = SessionLocks()
+        self.rate_limiter = get_rate_limiter(api_key)
+        self.assistant_registry = AssistantRegistry(self.client, rate_limiter=self.rate_limiter)
+        self.retry_policy = RetryPolicy.from_env()
+        self.hedger = Hedger.from_env()
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.model_router = ModelRouter.from_env(self.prompt_manager)
+        self.rollback_thread_messages = os.getenv("RETRY_ROLLBACK_THREAD_MESSAGES", "True").lower() == "true"
+        self.context_builder = ContextBuilder.from_env()
+        self.prompt_assembler = PromptAssembler(self.context_builder)
+        self.summarizer = None
+        if os.getenv("SUMMARY_ENABLED", "True").lower() == "true":
+            self.summarizer = ConversationSummarizer.from_env(self.client, rate_limiter=self.rate_limiter)
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+        self.response_cache = None
+        if os.getenv("RESPONSE_CACHE_ENABLED", "True").lower() == "true":
+            self.response_cache = ResponseCache.from_env(self.client, rate_limiter=self.rate_limiter)
+        self.single_flight = None
+        if os.getenv("COALESCE_ENABLED", "True").lower() == "true":
+            self.single_flight = SingleFlight()
+        # 缓存命中后补写到thread的消息，同一会话的下一轮run开始前必须完成
+        self._thread_sync_tasks: Dict[str, asyncio.Task] = {}
 
     async def create_chat_session(self, user_id: str, prompt_type: str = "default", 
-                                mode: ChatMode = ChatMode.NORMAL) -> ChatSession:
-        """Create a new chat session"""
-        session_id = str(uuid.uuid4())
+                                mode: ChatMode = ChatMode.NORMAL, lazy: bool = False,
+                                session_id: Optional[str] = None) -> ChatSession:
+        """Create a new chat session.
+
+        The OpenAI thread is only allocated when the first message is sent. With
+        lazy=True the session is not stored either; it is materialized by the first
+        send_message call that carries its prompt_type and mode.
+        """
+        session_id = session_id or str(uuid.uuid4())
         system_prompt = self.prompt_manager.get_system_prompt(prompt_type)
         
-        thread_id = None
-        if mode == ChatMode.NORMAL:
-            # Create OpenAI thread for normal mode
-            thread = self.client.beta.threads.create()
-            thread_id = thread.id
+        if lazy:
+            return ChatSession(
+                session_id=session_id,
+                user_id=user_id,
+                mode=mode,
+                system_prompt=system_prompt,
+                prompt_type=prompt_type
+            )
         
         session = self.session_manager.create_session(
             session_id=session_id,
             user_id=user_id,
             mode=mode,
             system_prompt=system_prompt,
-            prompt_type=prompt_type,
-            thread_id=thread_id
+            prompt_type=prompt_type
         )
         
         return session
 
-    def _enhance_user_message(self, user_message: str, session: ChatSession) -> str:
-        """Enhance user message with implicit prompt based on session configuration"""
+    async def _get_or_materialize_session(self, session_id: str, prompt_type: Optional[str] = None,
+                                          mode: Optional[ChatMode] = None) -> Optional[ChatSession]:
+        """Get a session, storing a lazily created one on its first message"""
+        session = self.session_manager.get_session(session_id)
+        if session or prompt_type is None or mode is None:
+            return session
+
+        try:
+            uuid.UUID(session_id)
+        except ValueError:
+            return None
+
+        return await self.create_chat_session(
+            user_id=str(uuid.uuid4()),
+            prompt_type=prompt_type,
+            mode=mode,
+            session_id=session_id
+        )
+
+    async def _limited(self, call: Callable[[], Awaitable[Any]],
+                       priority: Priority = Priority.INTERACTIVE) -> Any:
+        """Await one threads/assistants API call under a rate-limit permit"""
+        async with self.rate_limiter.permit(ASSISTANTS_LANE, priority=priority):
+            return await call()
+
+    async def _ensure_thread(self, session: ChatSession, priority: Priority = Priority.INTERACTIVE) -> str:
+        """Create the OpenAI thread for a normal mode session on first use"""
+        if not session.thread_id:
+            thread = await self._limited(self.client.beta.threads.create, priority)
+            session.thread_id = thread.id
+            self.session_manager.update_session(session)
+        return session.thread_id
+
+    def _get_implicit_prompt(self, session: ChatSession) -> str:
+        """Implicit prompt for the session's prompt type and mode"""
         # 根据会话的prompt_type和模式确定隐式prompt的模式
         session_mode = session.mode.value.lower()  # "normal" or "search"
         
@@ -57,209 +185,605 @@ class OpenAIService:
         else:
             implicit_mode = "normal"
         
-        # 获取隐式prompt
-        implicit_prompt = self.implicit_prompt_manager.get_implicit_prompt(implicit_mode)
-        
-        # 如果有隐式prompt，则拼接到用户消息中
-        if implicit_prompt:
-            enhanced_message = f"{user_message}\n\n[隐式指导]: {implicit_prompt}"
-            return enhanced_message
-        
-        return user_message
+        return self.implicit_prompt_manager.get_implicit_prompt(implicit_mode)
 
-    async def send_message_normal_mode(self, session_id: str, user_message: str) -> Dict[str, Any]:
-        """Send message using thread-based conversation (normal mode)"""
-        try:
-            session = self.session_manager.get_session(session_id)
-            if not session or session.mode != ChatMode.NORMAL:
-                raise ValueError("Invalid session or mode")
+    def _add_user_message(self, session: ChatSession, user_message: str) -> Message:
+        """Add the original user message to the session (without implicit prompt)"""
+        user_msg = Message(
+            role="user",
+            content=user_message,
+            timestamp=datetime.now(),
+            message_id=str(uuid.uuid4())
+        )
+        session.add_message(user_msg)
+        return user_msg
 
-            # Enhance user message with implicit prompt
-            enhanced_message = self._enhance_user_message(user_message, session)
+    def _complete_turn(self, session: ChatSession, assistant_response: str) -> Message:
+        """Persist the assistant message once the full answer is available"""
+        assistant_msg = Message(
+            role="assistant",
+            content=assistant_response,
+            timestamp=datetime.now(),
+            message_id=str(uuid.uuid4())
+        )
+        session.add_message(assistant_msg)
+        self.session_manager.update_session(session)
+        return assistant_msg
 
-            # Add original user message to session (without implicit prompt)
-            user_msg = Message(
-                role="user",
-                content=user_message,
-                timestamp=datetime.now(),
-                message_id=str(uuid.uuid4())
-            )
-            session.add_message(user_msg)
+    async def stream_message_normal_mode(self, session_id: str, user_message: str,
+                                         model: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a thread-based conversation turn (normal mode)"""
+        session = self.session_manager.get_session(session_id)
+        if not session or session.mode != ChatMode.NORMAL:
+            raise ValueError("Invalid session or mode")
+        model = model or self.model_router.route(session, user_message).model
+
+        # Earlier cached answers must reach the thread before this run starts
+        pending = self._thread_sync_tasks.pop(session_id, None)
+        if pending:
+            await pending
+
+        await self._ensure_thread(session)
 
-            # Create assistant if not exists
-            assistant = self.client.beta.assistants.create(
-                name="Chat Assistant",
+        user_msg = self._add_user_message(session, user_message)
+        thread_message = None
+        # The implicit prompt goes after the assistant instructions instead of
+        # into each thread message, so every run starts with the same prefix
+        implicit_prompt = self._get_implicit_prompt(session)
+
+        try:
+            # Reuse the registered assistant for this system prompt
+            # The assistant keeps the prompt type's main model; each run may override it
+            assistant_id = await self.assistant_registry.get_assistant_id(
                 instructions=session.system_prompt,
-                model="gpt-4o"
+                model=self.model_router.base_route(session.prompt_type).model
             )
 
-            # Add enhanced message to thread (with implicit prompt)
-            self.client.beta.threads.messages.create(
-                thread_id=session.thread_id,
-                role="user",
-                content=enhanced_message
+            thread_message = await self.retry_policy.run(
+                self._thread_message_creator(session.thread_id, user_message, user_msg.message_id),
+                name="threads.messages.create"
             )
 
-            # Run the assistant
-            run = self.client.beta.threads.runs.create(
-                thread_id=session.thread_id,
-                assistant_id=assistant.id
-            )
+            # Wait for a rate-limit slot; the run reads the whole thread
+            estimate = (count_tokens(session.system_prompt) + count_tokens(implicit_prompt)
+                        + sum(message_tokens(msg) for msg in session.messages))
+            permit = self.rate_limiter.permit(model, estimate, Priority.INTERACTIVE)
+            async for position in permit.wait():
+                yield {"type": "queued", "position": position, "reason": "rate_limit"}
 
-            # Wait for completion
-            while run.status in ['queued', 'in_progress', 'cancelling']:
-                import time
-                time.sleep(1)
-                run = self.client.beta.threads.runs.retrieve(
-                    thread_id=session.thread_id, 
-                    run_id=run.id
-                )
+            # Run the assistant and forward its streamed text deltas. A run that
+            # failed to start is retried; once text has been sent it is not.
+            attempt = 0
+            result = RunResult(run=None)
+            try:
+                while True:
+                    result = RunResult(run=None)
+                    chunks = []
+                    try:
+                        async for delta in self.run_waiter.stream_run(
+                            self.client,
+                            thread_id=session.thread_id,
+                            assistant_id=assistant_id,
+                            state=result,
+                            model=model,
+                            additional_instructions=implicit_prompt or NOT_GIVEN
+                        ):
+                            chunks.append(delta)
+                            yield {"type": "delta", "content": delta}
+                        break
+                    except NotFoundError:
+                        # The assistant may have been deleted remotely; recreate it next time
+                        self.assistant_registry.forget(assistant_id)
+                        raise
+                    except Exception as e:
+                        if chunks or result.run is not None or not self.retry_policy.should_retry(e, attempt):
+                            raise
+                        await asyncio.sleep(self.retry_policy.backoff(attempt))
+                        attempt += 1
+            finally:
+                permit.release(_usage_tokens(result.run))
 
-            if run.status == 'completed':
+            run = result.run
+            if run.status != 'completed':
+                raise RuntimeError(f"Run failed with status: {run.status}")
+
+            assistant_response = result.text if result.text is not None else "".join(chunks)
+            if not assistant_response:
                 # Get the latest message
-                messages = self.client.beta.threads.messages.list(thread_id=session.thread_id)
+                messages = await self.retry_policy.run(
+                    lambda: self._limited(
+                        lambda: self.client.beta.threads.messages.list(thread_id=session.thread_id, limit=1)
+                    ),
+                    name="threads.messages.list"
+                )
                 latest_message = messages.data[0]
-                
-                if latest_message.role == 'assistant':
-                    assistant_response = latest_message.content[0].text.value
-                    
-                    # Add assistant message to session
-                    assistant_msg = Message(
-                        role="assistant",
-                        content=assistant_response,
-                        timestamp=datetime.now(),
-                        message_id=str(uuid.uuid4())
-                    )
-                    session.add_message(assistant_msg)
-                    
-                    # Update session
-                    self.session_manager.update_session(session)
-                    
-                    # Clean up assistant
-                    self.client.beta.assistants.delete(assistant.id)
-                    
-                    return {
-                        "success": True,
-                        "response": assistant_response,
-                        "session_id": session_id
-                    }
-            
-            # Clean up assistant in case of error
-            self.client.beta.assistants.delete(assistant.id)
-            
-            return {
-                "success": False,
-                "error": f"Run failed with status: {run.status}",
-                "session_id": session_id
-            }
+                if latest_message.role != 'assistant':
+                    raise RuntimeError("No assistant reply found in thread")
+                assistant_response = latest_message.content[0].text.value
+        except BaseException:
+            self._rollback_user_message(session, user_msg, thread_message)
+            raise
 
-        except Exception as e:
-            return {
-                "success": False,
-                "error": str(e),
-                "session_id": session_id
-            }
+        self._complete_turn(session, assistant_response)
+        yield {"type": "done", "response": assistant_response, "model": model, "usage": _usage_split(run)}
 
-    async def send_message_search_mode(self, session_id: str, user_message: str) -> Dict[str, Any]:
-        """Send message using search-enabled conversation (search mode)"""
+    def _thread_message_creator(self, thread_id: str, content: str, message_id: str):
+        """Idempotent threads.messages.create: a retry first checks whether the last attempt landed"""
+        attempted = False
+
+        async def create():
+            nonlocal attempted
+            if attempted:
+                latest = await self._limited(
+                    lambda: self.client.beta.threads.messages.list(thread_id=thread_id, limit=1)
+                )
+                if latest.data and (latest.data[0].metadata or {}).get("message_id") == message_id:
+                    return latest.data[0]
+            attempted = True
+            return await self._limited(lambda: self.client.beta.threads.messages.create(
+                thread_id=thread_id,
+                role="user",
+                content=content,
+                metadata={"message_id": message_id}
+            ))
+
+        return create
+
+    def _rollback_user_message(self, session: ChatSession, user_msg: Message, thread_message=None):
+        """Drop the user message of a failed turn so a retry does not duplicate it"""
+        session.remove_message(user_msg.message_id)
+        if thread_message is not None and self.rollback_thread_messages:
+            asyncio.ensure_future(self._delete_thread_message(session.thread_id, thread_message.id))
+
+    async def _delete_thread_message(self, thread_id: str, message_id: str):
         try:
-            session = self.session_manager.get_session(session_id)
-            if not session or session.mode != ChatMode.SEARCH:
-                raise ValueError("Invalid session or mode")
+            await self._limited(
+                lambda: self.client.beta.threads.messages.delete(message_id=message_id, thread_id=thread_id),
+                Priority.BACKGROUND
+            )
+        except Exception as e:
+            print(f"⚠️  删除失败轮次的thread消息失败: {e}")
 
-            # Enhance user message with implicit prompt
-            enhanced_message = self._enhance_user_message(user_message, session)
+    async def stream_message_search_mode(self, session_id: str, user_message: str,
+                                         model: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a search-enabled conversation turn (search mode)"""
+        session = self.session_manager.get_session(session_id)
+        if not session or session.mode != ChatMode.SEARCH:
+            raise ValueError("Invalid session or mode")
+        model = model or self.model_router.route(session, user_message).model
 
-            # Add original user message to session (without implicit prompt)
-            user_msg = Message(
-                role="user",
-                content=user_message,
-                timestamp=datetime.now(),
-                message_id=str(uuid.uuid4())
+        user_msg = self._add_user_message(session, user_message)
+        implicit_prompt = self._get_implicit_prompt(session)
+
+        try:
+            chained = session.previous_response_id is not None
+            prompt = self.prompt_assembler.assemble(
+                session, user_message, implicit_prompt, SEARCH_INSTRUCTIONS, chained=chained
             )
-            session.add_message(user_msg)
-
-            # Get conversation history for context - this is important for multi-turn conversation
-            conversation_history = session.get_messages_for_api()
-            
-            # Create a comprehensive input that includes conversation context and enhanced message
-            context_input = self._build_context_input(conversation_history, enhanced_message)
-
-            # Use the OpenAI responses API with web_search_preview
-            response = self.client.responses.create(
-                model="gpt-4o",
-                tools=[{"type": "web_search_preview"}],
-                input=context_input
+
+            permit = self.rate_limiter.permit(model, prompt.tokens(), Priority.INTERACTIVE)
+            async for position in permit.wait():
+                yield {"type": "queued", "position": position, "reason": "rate_limit"}
+
+            async def open_stream(prompt, previous_response_id):
+                # Use the OpenAI responses API with web_search_preview
+                stream = await self.client.responses.create(
+                    model=model,
+                    instructions=prompt.instructions,
+                    tools=[{"type": "web_search_preview"}],
+                    input=prompt.input,
+                    previous_response_id=previous_response_id or NOT_GIVEN,
+                    truncation="auto",
+                    store=True,
+                    stream=True
+                )
+                events = stream.__aiter__()
+                try:
+                    first = await events.__anext__()
+                except StopAsyncIteration:
+                    first = None
+                return stream, events, first
+
+            def open_with_retry(prompt, previous_response_id):
+                # Nothing has been sent to the user until the first event arrives,
+                # so opening the stream is retried and may be hedged
+                return self.retry_policy.run(
+                    lambda: self.hedger.call(
+                        "responses.create",
+                        lambda: open_stream(prompt, previous_response_id),
+                        discard=_close_stream
+                    ),
+                    name="responses.create"
+                )
+
+            chunks = []
+            state = RunResult(run=None)
+            try:
+                try:
+                    _, events, first = await open_with_retry(prompt, session.previous_response_id)
+                except (BadRequestError, NotFoundError) as e:
+                    if not chained or not _is_chain_error(e):
+                        raise
+                    # The stored response expired or was deleted: resend the history instead
+                    print(f"⚠️  previous_response_id已失效，改为发送完整历史: {e}")
+                    session.previous_response_id = None
+                    prompt = self.prompt_assembler.assemble(session, user_message, implicit_prompt, SEARCH_INSTRUCTIONS)
+                    _, events, first = await open_with_retry(prompt, None)
+                async for delta in _response_text(_prepend(first, events), state):
+                    chunks.append(delta)
+                    yield {"type": "delta", "content": delta}
+            finally:
+                permit.release(_usage_tokens(state.run))
+        except BaseException:
+            self._rollback_user_message(session, user_msg)
+            raise
+
+        assistant_response = state.text if state.text is not None else "".join(chunks)
+
+        # The next turn only sends its own message on top of this stored response
+        session.previous_response_id = getattr(state.run, "id", None)
+        self._complete_turn(session, assistant_response)
+        self._schedule_summary(session)
+        yield {"type": "done", "response": assistant_response, "model": model, "usage": _usage_split(state.run)}
+
+    async def stream_message(self, session_id: str, user_message: str,
+                             prompt_type: Optional[str] = None,
+                             mode: Optional[ChatMode] = None) -> AsyncIterator[Dict[str, Any]]:
+        """Stream a reply as delta events followed by a single done (or error) event.
+
+        Sends to the same session are serialized in arrival order; a queued event
+        reports the position while waiting for earlier sends to finish.
+        """
+        position = self.session_locks.queue_depth(session_id)
+        if position:
+            yield {"type": "queued", "position": position, "session_id": session_id}
+
+        async with self.session_locks.hold(session_id) as held:
+            async for event in self._stream_message_locked(session_id, user_message, prompt_type, mode, held):
+                event["session_id"] = session_id
+                yield event
+
+    async def _stream_message_locked(self, session_id: str, user_message: str,
+                                     prompt_type: Optional[str],
+                                     mode: Optional[ChatMode],
+                                     held: SessionHold) -> AsyncIterator[Dict[str, Any]]:
+        try:
+            session = await self._get_or_materialize_session(session_id, prompt_type, mode)
+        except Exception as e:
+            yield {"type": "error", "error": str(e)}
+            return
+        if not session:
+            yield {"type": "error", "error": "Session not found"}
+            return
+
+        implicit_prompt = self._get_implicit_prompt(session)
+        if self.response_cache:
+            scope = self.response_cache.scope_for(session, implicit_prompt)
+            cached = await self.response_cache.get(scope, user_message)
+            if cached is not None:
+                self._answer_from_cache(session, user_message, cached)
+                yield {"type": "delta", "content": cached}
+                yield {"type": "done", "response": cached, "cached": True}
+                return
+        else:
+            scope = conversation_scope(session, implicit_prompt)
+
+        if self.single_flight:
+            # Identical in-flight requests share the leader's upstream call. The
+            # key covers the summary and every message after it, so only sessions
+            # with the same full history share an answer
+            history = conversation_scope(session, implicit_prompt,
+                                         len(session.messages) - session.summary_message_count)
+            key = f"{history}:{normalize_question(user_message)}"
+            events, leader = self.single_flight.join(
+                key, lambda: self._run_turn(session, user_message, scope)
             )
+            if leader:
+                # The shared call writes to the leader's session, so keep it locked
+                # until the call finishes even if the leader's client goes away
+                held.retain()
+                self.single_flight.add_done_callback(key, held.release)
+        else:
+            events, leader = self._run_turn(session, user_message, scope), True
+
+        try:
+            async for event in events:
+                if event["type"] == "done" and not leader:
+                    self._answer_from_cache(session, user_message, event["response"])
+                    event["coalesced"] = True
+                yield event
+        except Exception as e:
+            yield {"type": "error", "error": str(e)}
+
+    async def _run_turn(self, session: ChatSession, user_message: str, scope: str) -> AsyncIterator[Dict[str, Any]]:
+        """Call the routed model for one turn and cache the final answer"""
+        route = self.model_router.route(session, user_message)
+        model = route.model
+        if not self._breaker(model).allow():
+            simple = route.reason == "simple" and route.fallback_model is not None
+            if simple and self._breaker(route.fallback_model).allow():
+                # 只有小模型熔断时，主模型照常走完整的模式路径 (工具、thread、响应链)
+                model = route.fallback_model
+            else:
+                # 简单问题的fallback_model就是刚被熔断拒绝的主模型
+                fallback = None if simple else route.fallback_model
+                async for event in self._degraded_turn(session, user_message, scope, fallback):
+                    yield event
+                return
+
+        while True:
+            if session.mode == ChatMode.NORMAL:
+                events = self.stream_message_normal_mode(session.session_id, user_message, model=model)
+            else:
+                events = self.stream_message_search_mode(session.session_id, user_message, model=model)
+
+            answered = False
+            try:
+                async for event in self._guarded(model, events):
+                    answered = answered or event["type"] in ("delta", "done")
+                    if event["type"] == "done" and self.response_cache:
+                        await self.response_cache.put(scope, user_message, event["response"],
+                                                      self.response_cache.ttl_for(session.mode))
+                    yield event
+                return
+            except Exception as e:
+                # 小模型在输出任何内容之前因上游故障失败时，用主模型重新回答这一轮
+                if (model != route.model or route.reason != "simple" or answered
+                        or not route.fallback_model or not is_upstream_failure(e)
+                        or not self._breaker(route.fallback_model).allow()):
+                    raise
+                print(f"⚠️  {model} 调用失败，改用 {route.fallback_model} 重试: {e}")
+                model = route.fallback_model
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        breaker = self.breakers.get(model)
+        if breaker is None:
+            breaker = self.breakers[model] = CircuitBreaker.from_env(model)
+        return breaker
+
+    async def _guarded(self, model: str, events: AsyncIterator[Dict[str, Any]]) -> AsyncIterator[Dict[str, Any]]:
+        """Report an upstream call's outcome to the model's breaker and routing stats.
+
+        Breaker latency is the time to the first answer event; the routing stats
+        record the whole call. Time spent queued behind rate limits is excluded.
+        """
+        breaker = self._breaker(model)
+        started = time.monotonic()
+        recorded = False
+        try:
+            async for event in events:
+                if event["type"] == "queued":
+                    started = time.monotonic()
+                elif not recorded and event["type"] in ("delta", "done"):
+                    breaker.record_success(time.monotonic() - started)
+                    recorded = True
+                if event["type"] == "done":
+                    usage = event.get("usage", {})
+                    self.model_router.record(model, time.monotonic() - started, usage.get("input_tokens"),
+                                             usage.get("output_tokens"), usage.get("cached_tokens"))
+                yield event
+        except Exception as e:
+            self.model_router.record_error(model)
+            if not recorded and is_upstream_failure(e):
+                breaker.record_failure()
+                recorded = True
+            raise
+        finally:
+            if not recorded:
+                breaker.release()
 
-            assistant_response = response.output_text
+    async def _degraded_turn(self, session: ChatSession, user_message: str, scope: str,
+                             fallback_model: Optional[str]) -> AsyncIterator[Dict[str, Any]]:
+        """Answer fast while the routed model's breaker is open"""
+        stale = self.response_cache.get_stale(scope, user_message) if self.response_cache else None
+        if stale is not None:
+            self._answer_from_cache(session, user_message, stale)
+            yield {"type": "delta", "content": stale}
+            yield {"type": "done", "response": stale, "cached": True, "degraded": True}
+            return
 
-            # Add assistant message to session
-            assistant_msg = Message(
-                role="assistant",
-                content=assistant_response,
-                timestamp=datetime.now(),
-                message_id=str(uuid.uuid4())
+        if fallback_model and self._breaker(fallback_model).allow():
+            events = self._fallback_turn(session, user_message, fallback_model)
+            async for event in self._guarded(fallback_model, events):
+                yield event
+            return
+
+        yield {"type": "error", "error": DEGRADED_MESSAGE, "degraded": True}
+
+    async def _fallback_turn(self, session: ChatSession, user_message: str,
+                             model: str) -> AsyncIterator[Dict[str, Any]]:
+        """Answer with the fallback model through the responses API, without tools"""
+        user_msg = self._add_user_message(session, user_message)
+        chunks = []
+        state = RunResult(run=None)
+        try:
+            prompt = self.prompt_assembler.assemble(session, user_message, self._get_implicit_prompt(session))
+            permit = self.rate_limiter.permit(model, prompt.tokens(), Priority.INTERACTIVE)
+            async for position in permit.wait():
+                yield {"type": "queued", "position": position, "reason": "rate_limit"}
+            try:
+                stream = await self.client.responses.create(
+                    model=model,
+                    instructions=prompt.instructions or NOT_GIVEN,
+                    input=prompt.input,
+                    truncation="auto",
+                    store=False,
+                    stream=True
+                )
+                async for delta in _response_text(stream, state):
+                    chunks.append(delta)
+                    yield {"type": "delta", "content": delta}
+            finally:
+                permit.release(_usage_tokens(state.run))
+        except BaseException:
+            self._rollback_user_message(session, user_msg)
+            raise
+
+        assistant_response = state.text if state.text is not None else "".join(chunks)
+        self._finish_offline_turn(session, user_message, assistant_response)
+        yield {"type": "done", "response": assistant_response, "degraded": True,
+               "model": model, "usage": _usage_split(state.run)}
+
+    def _answer_from_cache(self, session: ChatSession, user_message: str, response: str):
+        """Record a cached or shared answer as a normal turn without calling the model"""
+        self._add_user_message(session, user_message)
+        self._finish_offline_turn(session, user_message, response)
+
+    def _finish_offline_turn(self, session: ChatSession, user_message: str, response: str):
+        """Complete a turn that did not go through the session's own thread run"""
+        self._complete_turn(session, response)
+        if session.mode == ChatMode.NORMAL:
+            # Mirror the turn into the thread so later runs still see it
+            previous = self._thread_sync_tasks.get(session.session_id)
+            task = asyncio.create_task(
+                self._append_to_thread(session, previous, user_message, response)
             )
-            session.add_message(assistant_msg)
+            self._thread_sync_tasks[session.session_id] = task
+            task.add_done_callback(lambda t, sid=session.session_id: self._forget_thread_sync(sid, t))
+        else:
+            # The stored response chain does not contain this turn
+            session.previous_response_id = None
+            self._schedule_summary(session)
 
-            # Update session
-            self.session_manager.update_session(session)
+    def is_degraded(self, prompt_type: str = "default") -> bool:
+        """Whether the prompt type's main model is unavailable and it has no fallback model"""
+        route = self.model_router.base_route(prompt_type)
+        return self._breaker(route.model).state == OPEN and not route.fallback_model
 
-            return {
-                "success": True,
-                "response": assistant_response,
-                "session_id": session_id
-            }
+    def get_breaker_states(self) -> Dict[str, str]:
+        """Circuit breaker state per model"""
+        return {model: breaker.state for model, breaker in self.breakers.items()}
+
+    def _forget_thread_sync(self, session_id: str, task: asyncio.Task):
+        if self._thread_sync_tasks.get(session_id) is task:
+            del self._thread_sync_tasks[session_id]
+
+    async def _append_to_thread(self, session: ChatSession, previous: Optional[asyncio.Task],
+                                user_message: str, response: str):
+        if previous:
+            await previous
+        try:
+            await self._ensure_thread(session, Priority.BACKGROUND)
+            for role, content in (("user", user_message), ("assistant", response)):
+                await self._limited(lambda: self.client.beta.threads.messages.create(
+                    thread_id=session.thread_id,
+                    role=role,
+                    content=content
+                ), Priority.BACKGROUND)
+        except Exception as e:
+            print(f"⚠️  缓存回答同步到thread失败: {e}")
 
+    async def _collect(self, events: AsyncIterator[Dict[str, Any]], session_id: str) -> Dict[str, Any]:
+        """Consume an event stream into the non-streaming result format"""
+        try:
+            async for event in events:
+                if event["type"] == "done":
+                    return {
+                        "success": True,
+                        "response": event["response"],
+                        "session_id": session_id
+                    }
+                if event["type"] == "error":
+                    return {
+                        "success": False,
+                        "error": event["error"],
+                        "session_id": session_id
+                    }
         except Exception as e:
             return {
                 "success": False,
                 "error": str(e),
                 "session_id": session_id
             }
+        return {
+            "success": False,
+            "error": "Stream ended without a response",
+            "session_id": session_id
+        }
 
-    def _build_context_input(self, conversation_history: List[Dict[str, str]], current_message: str) -> str:
-        """Build context input for web search mode to maintain conversation history"""
-        context_parts = []
-        
-        # Add system prompt
-        for msg in conversation_history:
-            if msg["role"] == "system":
-                context_parts.append(f"系统角色设定: {msg['content']}")
-                break
-        
-        # Add conversation history (limit to last 10 messages to avoid token limit)
-        recent_messages = [msg for msg in conversation_history if msg["role"] in ["user", "assistant"]][-10:]
-        
-        if recent_messages:
-            context_parts.append("对话历史:")
-            for msg in recent_messages:
-                role_name = "用户" if msg["role"] == "user" else "助手"
-                context_parts.append(f"{role_name}: {msg['content']}")
-        
-        # Add current message
-        context_parts.append(f"\n当前用户问题: {current_message}")
-        
-        # Add instruction for maintaining context
-        context_parts.append("\n请基于以上对话历史和当前问题，提供准确的回答。如果需要最新信息，请使用搜索功能。")
-        
-        return "\n".join(context_parts)
+    async def send_message_normal_mode(self, session_id: str, user_message: str) -> Dict[str, Any]:
+        """Send message using thread-based conversation (normal mode)"""
+        return await self._collect(self.stream_message_normal_mode(session_id, user_message), session_id)
+
+    async def send_message_search_mode(self, session_id: str, user_message: str) -> Dict[str, Any]:
+        """Send message using search-enabled conversation (search mode)"""
+        return await self._collect(self.stream_message_search_mode(session_id, user_message), session_id)
+
+    def _schedule_summary(self, session: ChatSession):
+        """Refresh the session summary in the background, off the request path"""
+        if self.summarizer is None or session.session_id in self._summary_tasks:
+            return
+        if not self.summarizer.needs_summary(session):
+            return
+        task = asyncio.create_task(self._refresh_summary(session.session_id))
+        self._summary_tasks[session.session_id] = task
+        task.add_done_callback(lambda _: self._summary_tasks.pop(session.session_id, None))
+
+    async def _refresh_summary(self, session_id: str):
+        """Fold older turns into the stored summary"""
+        try:
+            session = self.session_manager.get_session(session_id)
+            if not session:
+                return
+            start = session.summary_message_count
+            result = await self.summarizer.summarize(session)
+            if result is None:
+                return
+            summary, covered = result
+
+            # Apply between sends so the summary matches the history it replaced
+            async with self.session_locks.hold(session_id):
+                session = self.session_manager.get_session(session_id)
+                if session and session.summary_message_count == start and len(session.messages) >= covered:
+                    session.summary = summary
+                    session.summary_message_count = covered
+                    # Restart the response chain from the summary so it stops growing
+                    session.previous_response_id = None
+                    self.session_manager.update_session(session)
+        except Exception as e:
+            print(f"⚠️  会话摘要更新失败 {session_id}: {e}")
 
-    async def send_message(self, session_id: str, user_message: str) -> Dict[str, Any]:
+    async def send_message(self, session_id: str, user_message: str,
+                           prompt_type: Optional[str] = None,
+                           mode: Optional[ChatMode] = None) -> Dict[str, Any]:
         """Send message based on session mode"""
-        session = self.session_manager.get_session(session_id)
-        if not session:
-            return {
-                "success": False,
-                "error": "Session not found",
-                "session_id": session_id
-            }
+        return await self._collect(
+            self.stream_message(session_id, user_message, prompt_type, mode),
+            session_id
+        )
 
-        if session.mode == ChatMode.NORMAL:
-            return await self.send_message_normal_mode(session_id, user_message)
-        else:
-            return await self.send_message_search_mode(session_id, user_message)
+    async def reconcile_assistants(self) -> int:
+        """Delete orphaned assistants left behind by earlier runs"""
+        include_legacy = os.getenv("ASSISTANT_RECONCILE_LEGACY", "False").lower() == "true"
+        return await self.assistant_registry.reconcile(include_legacy=include_legacy)
+
+    async def collect_empty_sessions(self, max_age_seconds: float) -> int:
+        """Delete sessions that never received a message; the storage scan runs in a worker thread"""
+        candidates = await asyncio.to_thread(self.session_manager.find_empty_sessions, max_age_seconds)
+        return self.session_manager.collect_empty_sessions(max_age_seconds, candidates)
+
+    def get_queue_depth(self, session_id: str) -> int:
+        """Number of sends running or waiting for a session"""
+        return self.session_locks.queue_depth(session_id)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Runtime metrics for monitoring"""
+        return {
+            "session_locks": self.session_locks.stats(),
+            "session_cache": self.session_manager.cache_info(),
+            "response_cache": self.response_cache.stats() if self.response_cache else None,
+            "coalescing": self.single_flight.stats() if self.single_flight else None,
+            "http_pool": self.client_factory.pool_stats(),
+            "rate_limits": self.rate_limiter.stats(),
+            "hedging": self.hedger.stats(),
+            "circuit_breakers": {model: breaker.stats() for model, breaker in self.breakers.items()},
+            "models": self.model_router.stats(),
+            # 各worker的配置版本一致说明修改已同步
+            "config_versions": {
+                manager.config_file: manager.version
+                for manager in (self.prompt_manager, self.welcome_manager, self.implicit_prompt_manager)
+            }
+        }
 
     def get_session(self, session_id: str) -> Optional[ChatSession]:
         """Get session information"""
@@ -0,0 +1,40 @@
+"""
+页面预渲染 - 每种(模板, 模式, 界面名称, 欢迎语)组合只渲染一次，请求时仅替换会话ID
+"""
+
+from collections import OrderedDict
+from typing import Any, Hashable, Tuple
+
+from jinja2 import Environment
+
+SESSION_ID_PLACEHOLDER = "__SESSION_ID__"
+SESSION_ID_SHORT_PLACEHOLDER = "__SESSION_ID_SHORT__"
+
+
+class PrerenderedPages:
+    """Caches rendered templates keyed by their context; templates get the
+    session id as ``session_id`` / ``session_id_short`` placeholders."""
+
+    def __init__(self, env: Environment, max_pages: int = 64):
+        self.env = env
+        self.max_pages = max_pages
+        self._pages: "OrderedDict[Tuple[Hashable, ...], str]" = OrderedDict()
+
+    def render(self, template_name: str, session_id: str, **context: Any) -> str:
+        """Render template_name for a session; context values must be hashable"""
+        key = (template_name, *sorted(context.items()))
+        page = self._pages.get(key)
+        if page is None:
+            page = self.env.get_template(template_name).render(
+                session_id=SESSION_ID_PLACEHOLDER,
+                session_id_short=SESSION_ID_SHORT_PLACEHOLDER,
+                **context
+            )
+            self._pages[key] = page
+            # 欢迎语热加载后旧页面不再被访问，按LRU淘汰
+            if len(self._pages) > self.max_pages:
+                self._pages.popitem(last=False)
+        else:
+            self._pages.move_to_end(key)
+        return (page.replace(SESSION_ID_SHORT_PLACEHOLDER, session_id[:8])
+                    .replace(SESSION_ID_PLACEHOLDER, session_id))
@@ -0,0 +1,78 @@
+"""
+提示词组装 - 静态内容(系统提示、固定说明、隐式指导)在前且逐字节稳定，变化内容(摘要、历史、当前问题)在后，
+以便命中上游的前缀缓存
+"""
+
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional
+
+from .context_builder import ContextBuilder, count_tokens
+from .models import ChatSession
+
+SEARCH_INSTRUCTIONS = "请基于对话历史和当前问题提供准确的回答。如果需要最新信息，请使用搜索功能。"
+
+
+@lru_cache(maxsize=64)
+def build_instructions(system_prompt: str, mode_instructions: str = "", implicit_prompt: str = "") -> str:
+    """Join the static parts of a prompt in a fixed order; equal inputs give the same string object"""
+    parts = [part.strip() for part in (system_prompt, mode_instructions, implicit_prompt) if part and part.strip()]
+    return "\n\n".join(parts)
+
+
+@dataclass
+class AssembledPrompt:
+    instructions: str
+    input: List[Dict[str, str]]
+
+    def tokens(self) -> int:
+        """Estimated prompt tokens, used for rate limiting"""
+        return count_tokens(self.instructions) + sum(count_tokens(item["content"]) for item in self.input)
+
+
+class PromptAssembler:
+    """Lays out responses API requests as a stable prefix followed by the conversation.
+
+    Everything that is the same for every turn of a prompt type goes into
+    ``instructions``; the summary, the budgeted history and the current
+    message follow as role messages, oldest first.
+    """
+
+    def __init__(self, context_builder: ContextBuilder):
+        self.context_builder = context_builder
+
+    def assemble(self, session: ChatSession, current_message: str, implicit_prompt: str = "",
+                 mode_instructions: str = "", chained: bool = False) -> AssembledPrompt:
+        """Build the request for a turn whose user message was already added to the session.
+
+        With ``chained`` the turn continues a stored response, so only the new
+        message is sent.
+        """
+        instructions = build_instructions(session.system_prompt, mode_instructions, implicit_prompt)
+        current = {"role": "user", "content": current_message}
+        if chained:
+            return AssembledPrompt(instructions, [current])
+
+        input_messages = []
+        summary = f"对话摘要: {session.summary}" if session.summary else ""
+        if summary:
+            input_messages.append({"role": "developer", "content": summary})
+
+        # Pack history into the token budget, newest turns first; the current
+        # message is the session's last message and is excluded here
+        budget = self.context_builder.prefix_budget(f"{instructions}\n{summary}", current_message)
+        recent_messages = self.context_builder.select(
+            session.messages, budget, start=session.summary_message_count, end=len(session.messages) - 1
+        )
+        for msg, content in recent_messages:
+            input_messages.append({"role": msg.role, "content": content})
+
+        input_messages.append(current)
+        return AssembledPrompt(instructions, input_messages)
+
+
+def cached_tokens(usage: Any) -> Optional[int]:
+    """Prompt tokens served from the upstream prefix cache, if reported"""
+    details = getattr(usage, "input_tokens_details", None) or getattr(usage, "prompt_tokens_details", None)
+    cached = getattr(details, "cached_tokens", None)
+    return cached if isinstance(cached, int) else None
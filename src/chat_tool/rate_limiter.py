@@ -0,0 +1,219 @@
+"""
+上游限流 - 按模型的请求/令牌桶与并发控制，交互请求优先于后台任务
+"""
+
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from enum import IntEnum
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+
+
+# threads/messages/assistants端点不属于任何模型，共用这一条按请求计数的通道
+ASSISTANTS_LANE = "assistants"
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    BACKGROUND = 1
+
+
+class TokenBucket:
+    """Refills continuously up to capacity; the level may go negative after reconciling usage"""
+
+    def __init__(self, capacity: float, per_second: float):
+        self.capacity = capacity
+        self.per_second = per_second
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.per_second)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until amount can be taken (0 if available now)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.per_second
+
+    def take(self, amount: float):
+        self._refill()
+        self.level = min(self.capacity, self.level - amount)
+
+
+class _Lane:
+    def __init__(self, rpm: Optional[int], tpm: Optional[int], max_concurrency: Optional[int]):
+        self.requests = TokenBucket(rpm, rpm / 60) if rpm else None
+        self.tokens = TokenBucket(tpm, tpm / 60) if tpm else None
+        self.max_concurrency = max_concurrency
+        self.active = 0
+        self.waiters: List[Tuple[int, int]] = []
+        self.changed = asyncio.Event()
+
+    def ready_in(self, tokens: int) -> Optional[float]:
+        """0 if a call may start now, seconds to wait for the buckets, or None while at max concurrency"""
+        if self.max_concurrency and self.active >= self.max_concurrency:
+            return None
+        delay = 0.0
+        if self.requests:
+            delay = max(delay, self.requests.delay(1))
+        if self.tokens:
+            delay = max(delay, self.tokens.delay(tokens))
+        return delay
+
+    def notify(self):
+        # 唤醒所有等待者重新检查，随后换一个新的Event
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class Permit:
+    """One upstream call's place in its lane.
+
+    Iterate ``wait()`` to receive queue positions while waiting (or use
+    ``async with``), then call ``release()`` with the actual token usage.
+    """
+
+    def __init__(self, lane: _Lane, tokens: int, priority: Priority, seq: int):
+        self.lane = lane
+        self.tokens = tokens
+        self.entry = (int(priority), seq)
+        self.acquired = False
+
+    async def wait(self) -> AsyncIterator[int]:
+        """Yield the 1-based queue position whenever it changes, until the call may start"""
+        lane = self.lane
+        heapq.heappush(lane.waiters, self.entry)
+        last_position = None
+        try:
+            while True:
+                changed = lane.changed
+                delay = lane.ready_in(self.tokens) if lane.waiters[0] == self.entry else None
+                if delay == 0:
+                    self._grant()
+                    return
+                position = 1 + sum(1 for entry in lane.waiters if entry < self.entry)
+                if position != last_position:
+                    last_position = position
+                    yield position
+                    continue
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=delay)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if not self.acquired:
+                lane.waiters.remove(self.entry)
+                heapq.heapify(lane.waiters)
+                lane.notify()
+
+    def _grant(self):
+        lane = self.lane
+        heapq.heappop(lane.waiters)
+        lane.active += 1
+        if lane.requests:
+            lane.requests.take(1)
+        if lane.tokens:
+            lane.tokens.take(self.tokens)
+        self.acquired = True
+        lane.notify()
+
+    def release(self, used_tokens: Optional[int] = None):
+        """Free the concurrency slot and charge the difference between estimated and actual tokens"""
+        if not self.acquired:
+            return
+        self.acquired = False
+        lane = self.lane
+        lane.active -= 1
+        if used_tokens is not None and lane.tokens:
+            lane.tokens.take(used_tokens - self.tokens)
+        lane.notify()
+
+    async def __aenter__(self) -> 'Permit':
+        async for _ in self.wait():
+            pass
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+
+class RateLimiter:
+    """Client-side limits for one API key, with a separate lane per model.
+
+    Calls queue by priority instead of failing; a lane without limits lets
+    every call through immediately.
+    """
+
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None,
+                 max_concurrency: Optional[int] = None,
+                 model_limits: Optional[Dict[str, Tuple[Optional[int], Optional[int]]]] = None):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_concurrency = max_concurrency
+        self.model_limits = model_limits or {}
+        self._lanes: Dict[str, _Lane] = {}
+        self._seq = itertools.count()
+
+    @classmethod
+    def from_env(cls) -> 'RateLimiter':
+        """Build a limiter from RATE_LIMIT_* environment variables.
+
+        RATE_LIMIT_MODELS overrides the defaults per model, e.g.
+        "gpt-4o:500:30000,gpt-4o-mini:1000:200000" (model:rpm:tpm).
+        """
+        def optional_int(value: Optional[str]) -> Optional[int]:
+            return int(value) if value else None
+
+        model_limits = {}
+        for item in os.getenv("RATE_LIMIT_MODELS", "").split(","):
+            if item.strip():
+                model, rpm, tpm = (item.strip().split(":") + ["", ""])[:3]
+                model_limits[model] = (optional_int(rpm), optional_int(tpm))
+
+        return cls(
+            rpm=optional_int(os.getenv("RATE_LIMIT_RPM")),
+            tpm=optional_int(os.getenv("RATE_LIMIT_TPM")),
+            max_concurrency=optional_int(os.getenv("RATE_LIMIT_MAX_CONCURRENCY")),
+            model_limits=model_limits
+        )
+
+    def _lane(self, model: str) -> _Lane:
+        lane = self._lanes.get(model)
+        if lane is None:
+            rpm, tpm = self.model_limits.get(model, (self.rpm, self.tpm))
+            lane = self._lanes[model] = _Lane(rpm, tpm, self.max_concurrency)
+        return lane
+
+    def permit(self, model: str, tokens: int = 0, priority: Priority = Priority.INTERACTIVE) -> Permit:
+        """A permit for one call to model with an estimated token cost"""
+        return Permit(self._lane(model), tokens, priority, next(self._seq))
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Active calls, queued calls and remaining budget per model"""
+        stats = {}
+        for model, lane in self._lanes.items():
+            stats[model] = {
+                "active": lane.active,
+                "queued": len(lane.waiters),
+                "requests_available": round(lane.requests.level, 1) if lane.requests else None,
+                "tokens_available": round(lane.tokens.level) if lane.tokens else None
+            }
+        return stats
+
+
+_limiters: Dict[str, RateLimiter] = {}
+
+
+def get_rate_limiter(api_key: str) -> RateLimiter:
+    """The process-wide limiter for an API key"""
+    limiter = _limiters.get(api_key)
+    if limiter is None:
+        limiter = _limiters[api_key] = RateLimiter.from_env()
+    return limiter
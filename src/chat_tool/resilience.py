@@ -0,0 +1,165 @@
+"""
+上游调用容错 - 带抖动的指数退避重试与对冲请求
+"""
+
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional
+
+import openai
+
+# 可以安全重试的瞬时错误
+RETRYABLE_ERRORS = (
+    openai.APIConnectionError,  # 包括APITimeoutError
+    openai.RateLimitError,
+    openai.InternalServerError,
+    asyncio.TimeoutError,
+)
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Whether an upstream error is transient"""
+    return isinstance(error, RETRYABLE_ERRORS)
+
+
+class RetryPolicy:
+    """Exponential backoff with full jitter for idempotent upstream steps"""
+
+    def __init__(self, attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.attempts = max(1, attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    @classmethod
+    def from_env(cls) -> 'RetryPolicy':
+        """Build a policy from RETRY_* environment variables"""
+        return cls(
+            attempts=int(os.getenv("RETRY_ATTEMPTS", 3)),
+            base_delay=float(os.getenv("RETRY_BASE_DELAY", 0.5)),
+            max_delay=float(os.getenv("RETRY_MAX_DELAY", 8.0))
+        )
+
+    def backoff(self, attempt: int) -> float:
+        """Delay before retry number attempt + 1 (full jitter)"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def should_retry(self, error: BaseException, attempt: int) -> bool:
+        return attempt + 1 < self.attempts and is_retryable(error)
+
+    async def run(self, fn: Callable[[], Awaitable[Any]], name: str = "upstream call") -> Any:
+        """Await fn(), retrying transient errors"""
+        attempt = 0
+        while True:
+            try:
+                return await fn()
+            except Exception as e:
+                if not self.should_retry(e, attempt):
+                    raise
+                delay = self.backoff(attempt)
+                print(f"⚠️  {name} 失败，{delay:.2f}秒后重试 ({attempt + 1}/{self.attempts - 1}): {e}")
+                await asyncio.sleep(delay)
+                attempt += 1
+
+
+class LatencyTracker:
+    """Sliding window of call latencies"""
+
+    def __init__(self, window: int = 200):
+        self._samples: Deque[float] = deque(maxlen=window)
+
+    def record(self, seconds: float):
+        self._samples.append(seconds)
+
+    def quantile(self, q: float, min_samples: int = 1) -> Optional[float]:
+        """The q-quantile of recent latencies, or None with too few samples"""
+        if len(self._samples) < max(1, min_samples):
+            return None
+        ordered = sorted(self._samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class Hedger:
+    """Sends a duplicate request when the first is slower than the latency quantile.
+
+    Only use for idempotent calls: whichever request finishes first wins and the
+    other is cancelled; a loser that already finished is passed to ``discard``.
+    """
+
+    def __init__(self, enabled: bool = False, quantile: float = 0.95, min_samples: int = 20,
+                 window: int = 200):
+        self.enabled = enabled
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.window = window
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._stats = {"hedged": 0, "hedge_wins": 0}
+
+    @classmethod
+    def from_env(cls) -> 'Hedger':
+        """Build a hedger from HEDGE_* environment variables"""
+        return cls(
+            enabled=os.getenv("HEDGE_ENABLED", "False").lower() == "true",
+            quantile=float(os.getenv("HEDGE_QUANTILE", 0.95)),
+            min_samples=int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+        )
+
+    def _tracker(self, name: str) -> LatencyTracker:
+        tracker = self._trackers.get(name)
+        if tracker is None:
+            tracker = self._trackers[name] = LatencyTracker(self.window)
+        return tracker
+
+    async def call(self, name: str, fn: Callable[[], Awaitable[Any]],
+                   discard: Optional[Callable[[Any], Awaitable[None]]] = None) -> Any:
+        """Await fn(), hedging with a second fn() once the latency quantile has passed"""
+        tracker = self._tracker(name)
+        started = time.monotonic()
+        delay = tracker.quantile(self.quantile, self.min_samples) if self.enabled else None
+        if delay is None:
+            result = await fn()
+            tracker.record(time.monotonic() - started)
+            return result
+
+        primary = asyncio.ensure_future(fn())
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=delay)
+            if done:
+                tracker.record(time.monotonic() - started)
+                return primary.result()
+
+            self._stats["hedged"] += 1
+            hedge = asyncio.ensure_future(fn())
+            pending = {primary, hedge}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winners = [task for task in done if task.exception() is None]
+                if winners:
+                    tracker.record(time.monotonic() - started)
+                    if winners[0] is hedge:
+                        self._stats["hedge_wins"] += 1
+                    # 两个请求同时完成时，多出的结果同样需要释放
+                    pending.update(winners[1:])
+                    return winners[0].result()
+                error = next(iter(done)).exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+                if discard is not None:
+                    task.add_done_callback(lambda t: self._discard(t, discard))
+
+    @staticmethod
+    def _discard(task: asyncio.Task, discard: Callable[[Any], Awaitable[None]]):
+        if not task.cancelled() and task.exception() is None:
+            asyncio.ensure_future(discard(task.result()))
+
+    def stats(self) -> Dict[str, Any]:
+        """Hedge counters and current p-quantile per call"""
+        return dict(self._stats, latency={
+            name: tracker.quantile(self.quantile) for name, tracker in self._trackers.items()
+        })
@@ -0,0 +1,203 @@
+"""
+响应缓存 - 对重复问题直接返回已有回答（精确匹配 + 可选的语义相似度匹配）
+"""
+
+import hashlib
+import math
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence
+
+from .context_builder import count_tokens
+from .models import ChatMode, ChatSession
+from .rate_limiter import RateLimiter
+
+# 归一化时去掉的句末标点（中英文）
+_TRAILING_PUNCTUATION = "?？!！.。,，;；~～ "
+
+
+def normalize_question(text: str) -> str:
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    return re.sub(r"\s+", " ", text).strip().lower().rstrip(_TRAILING_PUNCTUATION)
+
+
+def _cosine(a: Sequence[float], b: Sequence[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+def conversation_scope(session: ChatSession, implicit_prompt: Optional[str],
+                       context_messages: int = 4) -> str:
+    """Hash of everything besides the question that shapes the answer.
+
+    Covers the prompt type, mode, system and implicit prompt, summary and the
+    last ``context_messages`` messages. Call before the current message is
+    added to the session.
+    """
+    digest = hashlib.sha256()
+    for part in (session.prompt_type, session.mode.value, session.system_prompt,
+                 implicit_prompt or "", session.summary):
+        digest.update(part.encode("utf-8"))
+        digest.update(b"\0")
+    if context_messages > 0:
+        for message in session.messages[-context_messages:]:
+            digest.update(f"{message.role}:{message.content}".encode("utf-8"))
+            digest.update(b"\0")
+    return digest.hexdigest()
+
+
+@dataclass
+class _CacheEntry:
+    scope: str
+    response: str
+    expires_at: float
+    embedding: Optional[List[float]] = None
+
+
+class ResponseCache:
+    """TTL + LRU cache of assistant answers for repeated questions.
+
+    Entries are keyed by a scope (prompt type, mode, system/implicit prompt and
+    a hash of the recent context) plus the normalized question. When
+    ``semantic_threshold`` is set, a miss falls back to comparing question
+    embeddings within the same scope.
+    """
+
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600.0, search_ttl: float = 300.0,
+                 context_messages: int = 4, semantic_threshold: Optional[float] = None,
+                 client=None, embedding_model: str = "text-embedding-3-small",
+                 rate_limiter: Optional[RateLimiter] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+        self.context_messages = context_messages
+        self.semantic_threshold = semantic_threshold
+        self.client = client
+        self.embedding_model = embedding_model
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self._entries: "OrderedDict[str, _CacheEntry]" = OrderedDict()
+        # 最近计算过的问题向量，未命中后写入缓存时复用
+        self._embeddings: "OrderedDict[str, List[float]]" = OrderedDict()
+        self._stats = {"hits": 0, "semantic_hits": 0, "misses": 0}
+
+    @classmethod
+    def from_env(cls, client=None, rate_limiter: Optional[RateLimiter] = None) -> 'ResponseCache':
+        """Build a cache from RESPONSE_CACHE_* environment variables"""
+        threshold = os.getenv("RESPONSE_CACHE_SEMANTIC_THRESHOLD")
+        return cls(
+            max_entries=int(os.getenv("RESPONSE_CACHE_SIZE", 1000)),
+            ttl=float(os.getenv("RESPONSE_CACHE_TTL", 3600)),
+            search_ttl=float(os.getenv("RESPONSE_CACHE_SEARCH_TTL", 300)),
+            context_messages=int(os.getenv("RESPONSE_CACHE_CONTEXT_MESSAGES", 4)),
+            semantic_threshold=float(threshold) if threshold else None,
+            client=client,
+            embedding_model=os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "text-embedding-3-small"),
+            rate_limiter=rate_limiter
+        )
+
+    def scope_for(self, session: ChatSession, implicit_prompt: Optional[str]) -> str:
+        """Scope of the session's next answer; call before adding the current message"""
+        return conversation_scope(session, implicit_prompt, self.context_messages)
+
+    def ttl_for(self, mode: ChatMode) -> float:
+        """Search answers depend on fresh web results and expire sooner"""
+        return self.search_ttl if mode == ChatMode.SEARCH else self.ttl
+
+    @staticmethod
+    def _key(scope: str, question: str) -> str:
+        return f"{scope}:{hashlib.sha256(question.encode('utf-8')).hexdigest()}"
+
+    def get_exact(self, scope: str, question: str) -> Optional[str]:
+        """Exact-match lookup; never calls the API"""
+        key = self._key(scope, normalize_question(question))
+        entry = self._entries.get(key)
+        # 过期条目暂不删除，由LRU淘汰；服务降级时仍可作为旧答案返回
+        if entry is None or entry.expires_at <= time.monotonic():
+            return None
+        self._entries.move_to_end(key)
+        return entry.response
+
+    def get_stale(self, scope: str, question: str) -> Optional[str]:
+        """Exact match ignoring the TTL, for when the model backend is unavailable"""
+        entry = self._entries.get(self._key(scope, normalize_question(question)))
+        return entry.response if entry is not None else None
+
+    async def get(self, scope: str, question: str) -> Optional[str]:
+        """Exact match first, then the embedding tier if it is enabled"""
+        response = self.get_exact(scope, question)
+        if response is not None:
+            self._stats["hits"] += 1
+            return response
+
+        if self.semantic_threshold is not None:
+            response = await self._get_similar(scope, normalize_question(question))
+            if response is not None:
+                self._stats["semantic_hits"] += 1
+                return response
+
+        self._stats["misses"] += 1
+        return None
+
+    async def put(self, scope: str, question: str, response: str, ttl: float):
+        """Store an answer; evicts least recently used entries beyond max_entries"""
+        if not response or ttl <= 0:
+            return
+        normalized = normalize_question(question)
+        embedding = None
+        if self.semantic_threshold is not None:
+            try:
+                embedding = await self._embed(normalized)
+            except Exception as e:
+                print(f"⚠️  计算问题向量失败，仅使用精确匹配: {e}")
+
+        key = self._key(scope, normalized)
+        self._entries[key] = _CacheEntry(scope, response, time.monotonic() + ttl, embedding)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    async def _get_similar(self, scope: str, normalized: str) -> Optional[str]:
+        try:
+            query = await self._embed(normalized)
+        except Exception as e:
+            print(f"⚠️  计算问题向量失败，跳过语义缓存: {e}")
+            return None
+
+        now = time.monotonic()
+        best_key, best_score = None, self.semantic_threshold
+        for key, entry in self._entries.items():
+            if entry.scope != scope or entry.embedding is None or entry.expires_at <= now:
+                continue
+            score = _cosine(query, entry.embedding)
+            if score >= best_score:
+                best_key, best_score = key, score
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        return self._entries[best_key].response
+
+    async def _embed(self, normalized: str) -> List[float]:
+        embedding = self._embeddings.get(normalized)
+        if embedding is not None:
+            self._embeddings.move_to_end(normalized)
+            return embedding
+        async with self.rate_limiter.permit(self.embedding_model, count_tokens(normalized)) as permit:
+            result = await self.client.embeddings.create(model=self.embedding_model, input=normalized)
+            permit.release(getattr(getattr(result, "usage", None), "total_tokens", None))
+        embedding = result.data[0].embedding
+        self._embeddings[normalized] = embedding
+        while len(self._embeddings) > self.max_entries:
+            self._embeddings.popitem(last=False)
+        return embedding
+
+    def clear(self):
+        self._entries.clear()
+        self._embeddings.clear()
+
+    def stats(self) -> Dict[str, int]:
+        """Hit/miss counters and current size"""
+        return dict(self._stats, entries=len(self._entries))
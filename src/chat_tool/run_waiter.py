@@ -0,0 +1,153 @@
+"""
+Assistants run 等待工具 - 自适应退避轮询与流式运行事件
+"""
+
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Iterator, Optional
+
+# 仍在执行中的run状态
+ACTIVE_RUN_STATUSES = ('queued', 'in_progress', 'cancelling')
+
+# 流式事件中表示run结束的事件类型
+TERMINAL_RUN_EVENTS = (
+    'thread.run.completed',
+    'thread.run.failed',
+    'thread.run.cancelled',
+    'thread.run.expired',
+    'thread.run.incomplete',
+    'thread.run.requires_action',
+)
+
+
+class RunTimeoutError(TimeoutError):
+    """Raised when a run does not finish before the waiter's deadline"""
+
+
+@dataclass
+class RunResult:
+    run: Any
+    text: Optional[str] = None
+
+
+class RunWaiter:
+    def __init__(self, initial_interval: float = 0.1, max_interval: float = 1.0,
+                 backoff: float = 1.5, timeout: float = 120.0):
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+
+    @classmethod
+    def from_env(cls, timeout: Optional[float] = None) -> 'RunWaiter':
+        """Build a waiter from RUN_POLL_* / RUN_TIMEOUT environment variables"""
+        return cls(
+            initial_interval=float(os.getenv("RUN_POLL_INITIAL_INTERVAL", 0.1)),
+            max_interval=float(os.getenv("RUN_POLL_MAX_INTERVAL", 1.0)),
+            backoff=float(os.getenv("RUN_POLL_BACKOFF", 1.5)),
+            timeout=timeout if timeout is not None else float(os.getenv("RUN_TIMEOUT", 120))
+        )
+
+    def intervals(self) -> Iterator[float]:
+        """Yield poll intervals: fast at first, then backing off to max_interval"""
+        interval = self.initial_interval
+        while True:
+            yield interval
+            interval = min(interval * self.backoff, self.max_interval)
+
+    async def wait(self, client, thread_id: str, run) -> Any:
+        """Poll an async client until the run leaves the active states"""
+        deadline = time.monotonic() + self.timeout
+        intervals = self.intervals()
+        try:
+            while run.status in ACTIVE_RUN_STATUSES:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    await self._cancel(client, thread_id, run.id)
+                    raise RunTimeoutError(f"Run {run.id} did not finish within {self.timeout}s")
+                await asyncio.sleep(min(next(intervals), remaining))
+                run = await client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        except asyncio.CancelledError:
+            # 请求被取消时同时取消远端run，避免线程被占用
+            await asyncio.shield(self._cancel(client, thread_id, run.id))
+            raise
+        return run
+
+    def wait_sync(self, client, thread_id: str, run) -> Any:
+        """Blocking variant of wait() for the synchronous OpenAI client"""
+        deadline = time.monotonic() + self.timeout
+        intervals = self.intervals()
+        while run.status in ACTIVE_RUN_STATUSES:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                try:
+                    client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run.id)
+                except Exception:
+                    pass
+                raise RunTimeoutError(f"Run {run.id} did not finish within {self.timeout}s")
+            time.sleep(min(next(intervals), remaining))
+            run = client.beta.threads.runs.retrieve(thread_id=thread_id, run_id=run.id)
+        return run
+
+    async def stream_run(self, client, thread_id: str, assistant_id: str,
+                         state: RunResult, **run_kwargs) -> AsyncIterator[str]:
+        """Create a run with stream=True and yield its text deltas as they arrive.
+
+        The final run and message text are recorded on ``state``. Falls back to
+        polling if the stream ends before a terminal event arrives.
+        """
+        deadline = time.monotonic() + self.timeout
+        stream = await client.beta.threads.runs.create(
+            thread_id=thread_id,
+            assistant_id=assistant_id,
+            stream=True,
+            **run_kwargs
+        )
+        events = stream.__aiter__()
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError
+                try:
+                    event = await asyncio.wait_for(events.__anext__(), timeout=remaining)
+                except StopAsyncIteration:
+                    break
+
+                if event.event == 'thread.run.created':
+                    state.run = event.data
+                elif event.event == 'thread.message.delta':
+                    for part in event.data.delta.content or []:
+                        if part.type == 'text' and part.text and part.text.value:
+                            yield part.text.value
+                elif event.event == 'thread.message.completed':
+                    for part in event.data.content:
+                        if part.type == 'text':
+                            state.text = part.text.value
+                            break
+                elif event.event in TERMINAL_RUN_EVENTS:
+                    state.run = event.data
+                    break
+        except asyncio.TimeoutError:
+            if state.run is not None:
+                await self._cancel(client, thread_id, state.run.id)
+            raise RunTimeoutError(f"Run did not finish within {self.timeout}s")
+        except (asyncio.CancelledError, GeneratorExit):
+            # 请求被取消或客户端断开时同时取消远端run
+            if state.run is not None and state.run.status in ACTIVE_RUN_STATUSES:
+                await asyncio.shield(self._cancel(client, thread_id, state.run.id))
+            raise
+
+        if state.run is None:
+            raise RuntimeError("Run stream ended before the run was created")
+        if state.run.status in ACTIVE_RUN_STATUSES:
+            state.run = await self.wait(client, thread_id, state.run)
+
+    async def _cancel(self, client, thread_id: str, run_id: str):
+        """Best-effort cancellation of a remote run"""
+        try:
+            await client.beta.threads.runs.cancel(thread_id=thread_id, run_id=run_id)
+        except Exception:
+            pass
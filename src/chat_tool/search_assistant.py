@@ -3,15 +3,18 @@
 """
 
 import os
-import time
 from typing import Dict, Any, Optional
-from openai import OpenAI
+from .run_waiter import RunWaiter
+from .client_factory import get_client_factory
 
 class SearchAssistant:
-    def __init__(self, api_key: str):
-        self.client = OpenAI(api_key=api_key)
+    def __init__(self, api_key: str, run_timeout: float = 60.0, model: str = "gpt-4o"):
+        # 复用进程内共享的客户端和连接池
+        self.client = get_client_factory(api_key).sync_client()
+        self.model = model
         self.assistant = None
         self.thread = None
+        self.run_waiter = RunWaiter.from_env(timeout=run_timeout)
     
     def create_search_assistant(self) -> str:
         """创建带搜索功能的助手"""
@@ -26,7 +29,7 @@ class SearchAssistant:
 2. 对于一般性知识问题，可以基于训练数据回答
 3. 搜索结果要准确、相关且有用
 4. 提供信息来源和时间""",
-                model="gpt-4o",
+                model=self.model,
                 tools=[
                     {"type": "web_search"}
                 ]
@@ -43,7 +46,7 @@ class SearchAssistant:
 2. 提供基于训练数据的相关信息
 3. 建议用户查看可靠的信息源
 4. 如果可能，提供查找最新信息的方法""",
-                model="gpt-4o"
+                model=self.model
             )
             return self.assistant.id
     
@@ -76,16 +79,8 @@ class SearchAssistant:
                 assistant_id=self.assistant.id
             )
             
-            # 等待完成
-            max_wait_time = 60  # 最大等待时间60秒
-            wait_time = 0
-            while run.status in ['queued', 'in_progress', 'cancelling'] and wait_time < max_wait_time:
-                time.sleep(1)
-                wait_time += 1
-                run = self.client.beta.threads.runs.retrieve(
-                    thread_id=self.thread.id, 
-                    run_id=run.id
-                )
+            # 等待完成（自适应退避轮询，超时后取消run）
+            run = self.run_waiter.wait_sync(self.client, self.thread.id, run)
             
             if run.status == 'completed':
                 # 获取最新消息
@@ -0,0 +1,72 @@
+import asyncio
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Dict
+
+
+class SessionHold:
+    """A held session lock, released once every holder has let go.
+
+    ``retain()`` lets work that outlives the send (e.g. a shared upstream call
+    the send started) keep the session locked until it finishes too.
+    """
+
+    def __init__(self, release: Callable[[], None]):
+        self._release = release
+        self._holders = 1
+
+    def retain(self):
+        self._holders += 1
+
+    def release(self):
+        self._holders -= 1
+        if not self._holders:
+            self._release()
+
+
+class SessionLocks:
+    """Per-session FIFO locks so sends to one session run one at a time.
+
+    Sends to different sessions never share a lock and run fully in parallel.
+    Locks are dropped as soon as no send is holding or waiting for them.
+    """
+
+    def __init__(self):
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._depths: Dict[str, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, session_id: str) -> AsyncIterator[SessionHold]:
+        """Wait for this session's turn, then hold its lock"""
+        lock = self._locks.setdefault(session_id, asyncio.Lock())
+        self._depths[session_id] = self._depths.get(session_id, 0) + 1
+        try:
+            await lock.acquire()
+        except BaseException:
+            self._leave(session_id)
+            raise
+        held = SessionHold(lambda: self._release(session_id, lock))
+        try:
+            yield held
+        finally:
+            held.release()
+
+    def _release(self, session_id: str, lock: asyncio.Lock):
+        lock.release()
+        self._leave(session_id)
+
+    def _leave(self, session_id: str):
+        self._depths[session_id] -= 1
+        if not self._depths[session_id]:
+            del self._depths[session_id]
+            del self._locks[session_id]
+
+    def queue_depth(self, session_id: str) -> int:
+        """Number of sends running or waiting for this session"""
+        return self._depths.get(session_id, 0)
+
+    def stats(self) -> Dict[str, int]:
+        """Aggregate lock usage"""
+        return {
+            "active_sessions": len(self._depths),
+            "queued_sends": sum(depth - 1 for depth in self._depths.values())
+        }
@@ -0,0 +1,114 @@
+"""
+静态资源 - 构建带内容哈希的文件名与预压缩版本，并以长期缓存头提供
+"""
+
+import gzip
+import hashlib
+import os
+from typing import Dict, Optional, Tuple
+
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope
+
+from .file_utils import atomic_write_bytes, atomic_write_json
+
+try:
+    import brotli
+except ImportError:  # brotli是可选依赖，缺失时只生成gzip版本
+    brotli = None
+
+ASSET_DIRS = ("css", "js")
+DIST_DIR = "dist"
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+# Accept-Encoding编码名与预压缩文件后缀，按优先顺序
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+
+def build_assets(static_dir: str = "static") -> Dict[str, str]:
+    """Copy css/ and js/ files to dist/ under content-hashed names with .gz/.br variants.
+
+    Returns and writes ``dist/manifest.json``, mapping e.g. "css/app.css" to
+    "dist/css/app.1a2b3c4d5e6f.css". Unchanged files are not rewritten.
+    """
+    manifest: Dict[str, str] = {}
+    for asset_dir in ASSET_DIRS:
+        source_dir = os.path.join(static_dir, asset_dir)
+        if not os.path.isdir(source_dir):
+            continue
+        for name in sorted(os.listdir(source_dir)):
+            source = os.path.join(source_dir, name)
+            if not os.path.isfile(source):
+                continue
+            with open(source, 'rb') as f:
+                data = f.read()
+            stem, ext = os.path.splitext(name)
+            digest = hashlib.sha256(data).hexdigest()[:12]
+            hashed = f"{DIST_DIR}/{asset_dir}/{stem}.{digest}{ext}"
+            manifest[f"{asset_dir}/{name}"] = hashed
+
+            target = os.path.join(static_dir, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            outputs = {target + ".gz": lambda: gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:
+                outputs[target + ".br"] = lambda: brotli.compress(data)
+            outputs[target] = lambda: data
+            for path, encode in outputs.items():
+                # 每个worker启动时都会构建；原子替换保证其他worker不会读到写了一半的文件
+                if not os.path.exists(path):
+                    atomic_write_bytes(path, encode())
+
+    atomic_write_json(os.path.join(static_dir, DIST_DIR, "manifest.json"), manifest)
+    return manifest
+
+
+class AssetManifest:
+    """Resolves logical asset paths to their fingerprinted URLs"""
+
+    def __init__(self, manifest: Dict[str, str], mount_path: str = "/static"):
+        self.manifest = manifest
+        self.mount_path = mount_path.rstrip("/")
+
+    def url(self, path: str) -> str:
+        """URL of an asset; files missing from the manifest are served unhashed"""
+        return f"{self.mount_path}/{self.manifest.get(path, path)}"
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """StaticFiles that serves fingerprinted files with immutable cache headers.
+
+    Under ``dist/`` a ``.br`` or ``.gz`` sibling is sent instead of the file
+    when the client accepts that encoding.
+    """
+
+    async def get_response(self, path: str, scope: Scope) -> Response:
+        if not path.startswith(f"{DIST_DIR}/"):
+            return await super().get_response(path, scope)
+
+        response = await super().get_response(path, scope)
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE
+        response.headers["Vary"] = "Accept-Encoding"
+        if not isinstance(response, FileResponse) or response.status_code != 200:
+            return response
+
+        variant = self._precompressed(response.path, scope)
+        if variant is None:
+            return response
+        full_path, encoding = variant
+        return FileResponse(
+            full_path,
+            media_type=response.media_type,
+            headers={"Cache-Control": IMMUTABLE_CACHE, "Vary": "Accept-Encoding", "Content-Encoding": encoding}
+        )
+
+    @staticmethod
+    def _precompressed(full_path: str, scope: Scope) -> Optional[Tuple[str, str]]:
+        accept = ""
+        for key, value in scope.get("headers", []):
+            if key == b"accept-encoding":
+                accept = value.decode("latin-1").lower()
+        accepted = {item.split(";")[0].strip() for item in accept.split(",")}
+        for encoding, suffix in ENCODINGS:
+            if encoding in accepted and os.path.isfile(full_path + suffix):
+                return full_path + suffix, encoding
+        return None
@@ -0,0 +1,477 @@
+"""
+会话存储 - 可插拔的存储后端 (JSON-lines日志目录 / SQLite)
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from .file_utils import atomic_write_text
+from .models import ChatSession, Message
+
+
+class SessionConflictError(RuntimeError):
+    """The stored session was changed by another worker since this process loaded it"""
+
+
+@dataclass
+class _LogState:
+    """What has already been written to a session's log.
+
+    Kept for every session this process has touched, so it holds a digest of the
+    header rather than the prompts and summary themselves.
+    """
+    message_count: int
+    last_message_id: Optional[str]
+    header_digest: str
+    redundant_records: int = 0
+
+
+def _header_without_timestamp(session: ChatSession) -> Dict[str, Any]:
+    header = session.header_dict()
+    header.pop("updated_at")
+    return header
+
+
+def _header_digest(session: ChatSession) -> str:
+    header = json.dumps(_header_without_timestamp(session), sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(header.encode('utf-8')).hexdigest()
+
+
+class SessionStore(ABC):
+    """Storage backend interface used by SessionManager"""
+
+    # Whether several processes may write to the store at once (SESSION_SHARED)
+    multiprocess_safe = False
+
+    @abstractmethod
+    def load(self, session_id: str) -> Optional[ChatSession]:
+        """Load a session, or return None if it is not stored"""
+
+    @abstractmethod
+    def save(self, session: ChatSession):
+        """Persist the session's current state"""
+
+    @abstractmethod
+    def delete(self, session_id: str) -> bool:
+        """Delete a session, returning whether it existed"""
+
+    @abstractmethod
+    def list_session_ids(self) -> List[str]:
+        """List ids of all stored sessions"""
+
+    @abstractmethod
+    def version(self, session_id: str) -> Optional[Any]:
+        """Cheap token that changes whenever the stored session changes"""
+
+    def list_user_session_ids(self, user_id: str) -> List[str]:
+        """List a user's session ids, most recently updated first"""
+        sessions = [self.load(session_id) for session_id in self.list_session_ids()]
+        sessions = [s for s in sessions if s and s.user_id == user_id]
+        return [s.session_id for s in sorted(sessions, key=lambda s: s.updated_at, reverse=True)]
+
+    def list_session_ids_updated_between(self, start: datetime, end: datetime) -> List[str]:
+        """List ids of sessions updated within [start, end)"""
+        sessions = [self.load(session_id) for session_id in self.list_session_ids()]
+        return [s.session_id for s in sessions if s and start <= s.updated_at < end]
+
+    def list_empty_session_ids(self, updated_before: datetime) -> List[str]:
+        """List ids of sessions without messages last updated before the cutoff"""
+        sessions = [self.load(session_id) for session_id in self.list_session_ids()]
+        return [s.session_id for s in sessions
+                if s and not s.messages and s.updated_at < updated_before]
+
+    def close(self):
+        """Release backend resources"""
+
+
+class JsonlSessionStore(SessionStore):
+    """Append-only session storage.
+
+    The first line of ``{session_id}.jsonl`` is the session header; each following
+    line is either a new message or a header update. New messages are appended, so
+    saving a turn costs O(new messages). The log is rewritten atomically (temp file +
+    rename) when it is first created and when redundant header updates or torn lines
+    have accumulated past ``compact_every``.
+    """
+
+    def __init__(self, storage_dir: str = "data/sessions", compact_every: int = 50):
+        self.storage_dir = storage_dir
+        self.compact_every = compact_every
+        os.makedirs(storage_dir, exist_ok=True)
+        self._state: Dict[str, _LogState] = {}
+
+    def _log_file(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.jsonl")
+
+    def _legacy_file(self, session_id: str) -> str:
+        return os.path.join(self.storage_dir, f"{session_id}.json")
+
+    def list_session_ids(self) -> List[str]:
+        """List ids of all stored sessions"""
+        session_ids = set()
+        for filename in os.listdir(self.storage_dir):
+            if filename.endswith(".jsonl"):
+                session_ids.add(filename[:-6])
+            elif filename.endswith(".json"):
+                session_ids.add(filename[:-5])
+        return sorted(session_ids)
+
+    def load(self, session_id: str) -> Optional[ChatSession]:
+        """Load a session from its log (or from a legacy full-JSON file)"""
+        log_file = self._log_file(session_id)
+        if os.path.exists(log_file):
+            return self._load_log(session_id, log_file)
+
+        legacy_file = self._legacy_file(session_id)
+        if os.path.exists(legacy_file):
+            with open(legacy_file, 'r', encoding='utf-8') as f:
+                # 旧格式会在下一次保存时迁移为日志格式
+                return ChatSession.from_dict(json.load(f))
+        return None
+
+    def _load_log(self, session_id: str, log_file: str) -> Optional[ChatSession]:
+        header: Dict[str, Any] = {}
+        messages: List[Message] = []
+        redundant = -1
+        corrupt = False
+        with open(log_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                    record_type = record.pop("type")
+                    if record_type == "header":
+                        header.update(record)
+                        redundant += 1
+                    elif record_type == "message":
+                        messages.append(Message.from_dict(record))
+                except (ValueError, KeyError) as e:
+                    # 崩溃时可能留下写了一半的最后一行，跳过即可
+                    print(f"Skipping corrupt record in session {session_id}: {e}")
+                    corrupt = True
+
+        if not header:
+            return None
+
+        session = ChatSession.from_dict({**header, "messages": []})
+        session.messages = messages
+        if messages and messages[-1].timestamp > session.updated_at:
+            session.updated_at = messages[-1].timestamp
+
+        if corrupt:
+            # 不记录日志状态，下一次保存时整体重写，避免在残缺行后继续追加
+            self._state.pop(session_id, None)
+        else:
+            self._state[session_id] = _LogState(
+                message_count=len(messages),
+                last_message_id=messages[-1].message_id if messages else None,
+                header_digest=_header_digest(session),
+                redundant_records=max(redundant, 0)
+            )
+        return session
+
+    def save(self, session: ChatSession):
+        """Append new messages and header changes, or rewrite the log if needed"""
+        state = self._state.get(session.session_id)
+        if state is None or not os.path.exists(self._log_file(session.session_id)):
+            self.compact(session)
+            return
+
+        count = state.message_count
+        messages = session.messages
+        if len(messages) < count or (count and messages[count - 1].message_id != state.last_message_id):
+            # 历史被修改（例如消息被回滚），重写整个日志
+            self.compact(session)
+            return
+
+        records = []
+        header_digest = _header_digest(session)
+        if header_digest != state.header_digest:
+            records.append({"type": "header", **session.header_dict()})
+            state.redundant_records += 1
+        for message in messages[count:]:
+            records.append({"type": "message", **message.to_dict()})
+
+        if not records:
+            return
+
+        with open(self._log_file(session.session_id), 'a', encoding='utf-8') as f:
+            f.write("".join(json.dumps(r, ensure_ascii=False) + "\n" for r in records))
+
+        state.message_count = len(messages)
+        state.last_message_id = messages[-1].message_id if messages else None
+        state.header_digest = header_digest
+
+        if state.redundant_records >= self.compact_every:
+            self.compact(session)
+
+    def compact(self, session: ChatSession):
+        """Atomically rewrite the log as one header line plus one line per message"""
+        lines = [json.dumps({"type": "header", **session.header_dict()}, ensure_ascii=False)]
+        lines.extend(
+            json.dumps({"type": "message", **message.to_dict()}, ensure_ascii=False)
+            for message in session.messages
+        )
+        atomic_write_text(self._log_file(session.session_id), "\n".join(lines) + "\n")
+
+        legacy_file = self._legacy_file(session.session_id)
+        if os.path.exists(legacy_file):
+            os.remove(legacy_file)
+
+        self._state[session.session_id] = _LogState(
+            message_count=len(session.messages),
+            last_message_id=session.messages[-1].message_id if session.messages else None,
+            header_digest=_header_digest(session)
+        )
+
+    def list_empty_session_ids(self, updated_before: datetime) -> List[str]:
+        """List ids of sessions without messages last updated before the cutoff.
+
+        Only the header records at the start of each log are parsed; reading stops
+        at the first message, so sessions with history cost one short read.
+        """
+        empty_ids = []
+        for session_id in self.list_session_ids():
+            log_file = self._log_file(session_id)
+            if not os.path.exists(log_file):
+                # 旧格式文件很少，直接完整加载
+                session = self.load(session_id)
+                if session and not session.messages and session.updated_at < updated_before:
+                    empty_ids.append(session_id)
+                continue
+
+            updated_at = None
+            has_messages = False
+            try:
+                with open(log_file, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            continue
+                        if record.get("type") == "message":
+                            has_messages = True
+                            break
+                        if record.get("type") == "header" and "updated_at" in record:
+                            updated_at = datetime.fromisoformat(record["updated_at"])
+            except FileNotFoundError:
+                continue
+            if not has_messages and updated_at is not None and updated_at < updated_before:
+                empty_ids.append(session_id)
+        return empty_ids
+
+    def version(self, session_id: str) -> Optional[Any]:
+        for path in (self._log_file(session_id), self._legacy_file(session_id)):
+            try:
+                stat = os.stat(path)
+                return (stat.st_mtime_ns, stat.st_size)
+            except FileNotFoundError:
+                continue
+        return None
+
+    def delete(self, session_id: str) -> bool:
+        """Delete a session's log"""
+        self._state.pop(session_id, None)
+        deleted = False
+        for path in (self._log_file(session_id), self._legacy_file(session_id)):
+            if os.path.exists(path):
+                os.remove(path)
+                deleted = True
+        return deleted
+
+
+class SQLiteSessionStore(SessionStore):
+    """SQLite session storage in WAL mode.
+
+    Sessions and messages live in separate tables; ``user_id``, ``updated_at`` and
+    ``mode`` are indexed so per-user listing and time-range queries stay fast with
+    millions of stored messages. Saving a turn inserts only the new messages.
+    """
+
+    multiprocess_safe = True
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            user_id TEXT NOT NULL,
+            mode TEXT NOT NULL,
+            prompt_type TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            last_message_id TEXT,
+            header TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS messages (
+            session_id TEXT NOT NULL REFERENCES sessions(session_id) ON DELETE CASCADE,
+            seq INTEGER NOT NULL,
+            message_id TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            timestamp TEXT NOT NULL,
+            PRIMARY KEY (session_id, seq)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS idx_sessions_user_updated ON sessions(user_id, updated_at);
+        CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions(updated_at);
+        CREATE INDEX IF NOT EXISTS idx_sessions_mode ON sessions(mode, updated_at);
+    """
+
+    def __init__(self, db_path: str = "data/sessions.db"):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute("PRAGMA foreign_keys=ON")
+        self._conn.executescript(self.SCHEMA)
+        # session_id -> 本进程最后读到或写入的 (message_count, last_message_id)
+        self._known: Dict[str, Tuple[int, Optional[str]]] = {}
+
+    def load(self, session_id: str) -> Optional[ChatSession]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT header FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            message_rows = self._conn.execute(
+                "SELECT role, content, timestamp, message_id FROM messages "
+                "WHERE session_id = ? ORDER BY seq",
+                (session_id,)
+            ).fetchall()
+            self._known[session_id] = (len(message_rows), message_rows[-1][3] if message_rows else None)
+
+        session = ChatSession.from_dict({**json.loads(row[0]), "messages": []})
+        session.messages = [
+            Message(role=role, content=content, timestamp=datetime.fromisoformat(timestamp),
+                    message_id=message_id)
+            for role, content, timestamp, message_id in message_rows
+        ]
+        return session
+
+    def save(self, session: ChatSession):
+        """Append new messages, compare-and-swap on the stored (message_count, last_message_id).
+
+        Raises SessionConflictError when another worker changed the session
+        after this process last read or wrote it.
+        """
+        messages = session.messages
+        with self._lock, self._conn:
+            # 写事务从读取开始，避免两个进程基于同一版本各自写入
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT message_count, last_message_id FROM sessions WHERE session_id = ?",
+                (session.session_id,)
+            ).fetchone()
+            stored = tuple(row) if row else None
+            known = self._known.get(session.session_id)
+            count, last_message_id = stored or (0, None)
+            extends = len(messages) >= count and (not count or messages[count - 1].message_id == last_message_id)
+            if stored is not None and stored != known and not (known is None and extends):
+                raise SessionConflictError(f"Session {session.session_id} was modified by another worker")
+            if not extends:
+                # 本进程回滚了历史（存储内容与本进程上次写入一致），重写该会话的消息
+                self._conn.execute("DELETE FROM messages WHERE session_id = ?", (session.session_id,))
+                count = 0
+
+            self._conn.execute(
+                """
+                INSERT INTO sessions (session_id, user_id, mode, prompt_type, created_at,
+                                      updated_at, message_count, last_message_id, header)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(session_id) DO UPDATE SET
+                    user_id = excluded.user_id,
+                    mode = excluded.mode,
+                    prompt_type = excluded.prompt_type,
+                    updated_at = excluded.updated_at,
+                    message_count = excluded.message_count,
+                    last_message_id = excluded.last_message_id,
+                    header = excluded.header
+                """,
+                (
+                    session.session_id,
+                    session.user_id,
+                    session.mode.value,
+                    session.prompt_type,
+                    session.created_at.timestamp(),
+                    session.updated_at.timestamp(),
+                    len(messages),
+                    messages[-1].message_id if messages else None,
+                    json.dumps(session.header_dict(), ensure_ascii=False)
+                )
+            )
+            self._conn.executemany(
+                "INSERT INTO messages (session_id, seq, message_id, role, content, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (session.session_id, seq, m.message_id, m.role, m.content, m.timestamp.isoformat())
+                    for seq, m in enumerate(messages[count:], start=count)
+                ]
+            )
+        self._known[session.session_id] = (len(messages), messages[-1].message_id if messages else None)
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock, self._conn:
+            cursor = self._conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            self._known.pop(session_id, None)
+            return cursor.rowcount > 0
+
+    def version(self, session_id: str) -> Optional[Any]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT updated_at, message_count, last_message_id FROM sessions WHERE session_id = ?",
+                (session_id,)
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def list_session_ids(self) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute("SELECT session_id FROM sessions").fetchall()
+        return [row[0] for row in rows]
+
+    def list_user_session_ids(self, user_id: str) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id FROM sessions WHERE user_id = ? ORDER BY updated_at DESC",
+                (user_id,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def list_session_ids_updated_between(self, start: datetime, end: datetime) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id FROM sessions WHERE updated_at >= ? AND updated_at < ? "
+                "ORDER BY updated_at",
+                (start.timestamp(), end.timestamp())
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def list_empty_session_ids(self, updated_before: datetime) -> List[str]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT session_id FROM sessions WHERE updated_at < ? AND message_count = 0",
+                (updated_before.timestamp(),)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def create_session_store(storage_dir: str = "data/sessions", backend: Optional[str] = None) -> SessionStore:
+    """Build the session store selected by SESSION_BACKEND ("jsonl" or "sqlite")"""
+    backend = (backend or os.getenv("SESSION_BACKEND", "jsonl")).lower()
+    if backend == "sqlite":
+        db_path = os.getenv("SESSION_DB_PATH") or os.path.join(storage_dir, "sessions.db")
+        return SQLiteSessionStore(db_path)
+    if backend == "jsonl":
+        return JsonlSessionStore(storage_dir)
+    raise ValueError(f"Unknown session backend: {backend}")
@@ -0,0 +1,73 @@
+"""
+对话摘要 - 将较早的对话轮次折叠进会话的滚动摘要
+"""
+
+import os
+from typing import Optional, Tuple
+
+from .context_builder import count_tokens, message_tokens
+from .models import ChatSession
+from .rate_limiter import Priority, RateLimiter
+
+SUMMARY_INSTRUCTIONS = (
+    "你负责维护一段对话的滚动摘要。请将已有摘要与新的对话内容合并为一段简洁的摘要，"
+    "保留关键事实、结论、用户的偏好与约束以及尚未解决的问题，不要添加对话中没有的信息。"
+)
+
+
+class ConversationSummarizer:
+    """Folds older turns into ChatSession.summary once they exceed a token threshold.
+
+    The newest ``keep_recent`` messages are always kept verbatim, so each turn's
+    prompt is roughly summary + recent turns regardless of conversation length.
+    """
+
+    def __init__(self, client, model: str = "gpt-4o-mini", threshold_tokens: int = 3000,
+                 keep_recent: int = 6, rate_limiter: Optional[RateLimiter] = None):
+        self.client = client
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.model = model
+        self.threshold_tokens = threshold_tokens
+        self.keep_recent = keep_recent
+
+    @classmethod
+    def from_env(cls, client, rate_limiter: Optional[RateLimiter] = None) -> 'ConversationSummarizer':
+        """Build a summarizer from SUMMARY_* environment variables"""
+        return cls(
+            client,
+            rate_limiter=rate_limiter,
+            model=os.getenv("SUMMARY_MODEL", "gpt-4o-mini"),
+            threshold_tokens=int(os.getenv("SUMMARY_THRESHOLD_TOKENS", 3000)),
+            keep_recent=int(os.getenv("SUMMARY_KEEP_RECENT", 6))
+        )
+
+    def needs_summary(self, session: ChatSession) -> bool:
+        """Whether the unsummarized turns outside the recent window exceed the threshold"""
+        end = len(session.messages) - self.keep_recent
+        if end <= session.summary_message_count:
+            return False
+        pending = session.messages[session.summary_message_count:end]
+        return sum(message_tokens(msg) for msg in pending) >= self.threshold_tokens
+
+    async def summarize(self, session: ChatSession) -> Optional[Tuple[str, int]]:
+        """Return (new summary, messages covered), or None if nothing to fold"""
+        end = len(session.messages) - self.keep_recent
+        start = session.summary_message_count
+        if end <= start:
+            return None
+
+        transcript = "\n".join(
+            f"{'用户' if msg.role == 'user' else '助手'}: {msg.content}"
+            for msg in session.messages[start:end]
+            if msg.role in ("user", "assistant")
+        )
+        summary_input = f"已有摘要:\n{session.summary or '（无）'}\n\n新的对话内容:\n{transcript}"
+        # 摘要是后台任务，限流时排在交互请求之后
+        async with self.rate_limiter.permit(self.model, count_tokens(summary_input), Priority.BACKGROUND) as permit:
+            response = await self.client.responses.create(
+                model=self.model,
+                instructions=SUMMARY_INSTRUCTIONS,
+                input=summary_input
+            )
+            permit.release(getattr(getattr(response, "usage", None), "total_tokens", None))
+        return response.output_text.strip(), end
@@ -72,6 +72,30 @@ def create_directories():
     
     print("✅ 目录结构创建完成")
 
+def get_worker_count():
+    """解析 --workers 参数 (数字或 auto)，默认读取 WORKERS 环境变量"""
+    value = os.getenv("WORKERS", "1")
+    for i, arg in enumerate(sys.argv):
+        if arg == "--workers":
+            value = sys.argv[i + 1] if i + 1 < len(sys.argv) and not sys.argv[i + 1].startswith("--") else "auto"
+        elif arg.startswith("--workers="):
+            value = arg.split("=", 1)[1]
+    
+    if value == "auto":
+        return os.cpu_count() or 1
+    return max(1, int(value))
+
+def configure_shared_state(workers):
+    """多worker模式下使用跨进程共享的会话存储"""
+    if workers <= 1:
+        return
+    # 只有SQLite (WAL) 能被多个进程安全地同时写入；子进程继承这些环境变量
+    backend = os.getenv("SESSION_BACKEND", "sqlite").lower()
+    if backend != "sqlite":
+        print(f"⚠️  SESSION_BACKEND={backend} 不支持多worker并发写入，已改用 sqlite")
+    os.environ["SESSION_BACKEND"] = "sqlite"
+    os.environ["SESSION_SHARED"] = "true"
+
 def main():
     """主函数"""
     print("🚀 Chat Tool 启动中...\n")
@@ -117,10 +141,18 @@ def main():
     host = os.getenv("HOST", "localhost")
     port = int(os.getenv("PORT", 8000))
     debug = os.getenv("DEBUG", "False").lower() == "true"
+    workers = get_worker_count()
+    if debug and workers > 1:
+        print("⚠️  调试模式 (--reload) 不支持多worker，使用单进程启动")
+        workers = 1
+    configure_shared_state(workers)
     
     print(f"🌟 启动 Chat Tool 服务...")
     print(f"📍 地址: http://{host}:{port}")
     print(f"🔧 调试模式: {'开启' if debug else '关闭'}")
+    print(f"⚙️  Worker进程数: {workers}")
+    if workers > 1:
+        print(f"🗄️  会话存储: {os.environ['SESSION_BACKEND']} (多进程共享)")
     print("\n按 Ctrl+C 停止服务\n")
     
     # 启动服务
@@ -138,7 +170,8 @@ def main():
                 sys.executable, "-m", "uvicorn", 
                 "src.chat_tool.main:app",
                 "--host", host,
-                "--port", str(port)
+                "--port", str(port),
+                "--workers", str(workers)
             ])
     except KeyboardInterrupt:
         print("\n👋 Chat Tool 服务已停止")
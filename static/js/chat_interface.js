@@ -0,0 +1,219 @@
+// 会话信息由页面的data属性提供，脚本本身与会话无关，可长期缓存
+const sessionId = document.body.dataset.sessionId;
+const promptType = document.body.dataset.promptType;
+const chatMode = document.body.dataset.mode;
+let lastUserMessage = '';
+let isWaitingForResponse = false;
+
+const chatMessages = document.getElementById('chatMessages');
+const messageInput = document.getElementById('messageInput');
+const sendButton = document.getElementById('sendButton');
+const typingIndicator = document.getElementById('typingIndicator');
+const errorMessage = document.getElementById('errorMessage');
+const errorText = document.getElementById('errorText');
+
+// Auto-resize textarea
+messageInput.addEventListener('input', function() {
+    this.style.height = 'auto';
+    this.style.height = Math.min(this.scrollHeight, 150) + 'px';
+});
+
+// Send message on Ctrl+Enter (Enter alone for new line)
+messageInput.addEventListener('keydown', function(e) {
+    if (e.key === 'Enter' && e.ctrlKey) {
+        e.preventDefault();
+        sendMessage();
+    }
+});
+
+async function sendMessage() {
+    const message = messageInput.value.trim();
+    if (!message || isWaitingForResponse) return;
+
+    lastUserMessage = message;
+    messageInput.value = '';
+    messageInput.style.height = 'auto';
+    
+    // Add user message to chat
+    addMessage('user', message);
+    
+    // Show typing indicator
+    showTypingIndicator();
+    hideError();
+    
+    // Disable input
+    setInputState(false);
+
+    console.log('Sending message to session:', sessionId);
+    console.log('Message content:', message);
+
+    try {
+        const response = await fetch(`/api/sessions/${sessionId}/messages/stream`, {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify({
+                message: message,
+                prompt_type: promptType,
+                mode: chatMode
+            })
+        });
+
+        if (!response.ok || !response.body) {
+            throw new Error(`HTTP ${response.status}`);
+        }
+
+        // Render tokens as they arrive
+        let contentElement = null;
+        await readEventStream(response, (event) => {
+            if (event.type === 'delta') {
+                if (!contentElement) {
+                    hideTypingIndicator();
+                    contentElement = addMessage('assistant', '');
+                }
+                contentElement.textContent += event.content;
+                scrollToBottom();
+            } else if (event.type === 'done') {
+                if (!contentElement) {
+                    contentElement = addMessage('assistant', '');
+                }
+                contentElement.textContent = event.response;
+            } else if (event.type === 'error') {
+                showError(event.error || '发送消息失败');
+            }
+        });
+    } catch (error) {
+        console.error('Request error:', error);
+        showError('网络错误，请检查连接后重试');
+    } finally {
+        hideTypingIndicator();
+        setInputState(true);
+    }
+}
+
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    while (true) {
+        const { done, value } = await reader.read();
+        if (done) break;
+
+        buffer += decoder.decode(value, { stream: true });
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+            const chunk = buffer.slice(0, boundary);
+            buffer = buffer.slice(boundary + 2);
+            const data = chunk.split('\n')
+                .filter(line => line.startsWith('data:'))
+                .map(line => line.slice(5).trim())
+                .join('\n');
+            if (data) {
+                onEvent(JSON.parse(data));
+            }
+        }
+    }
+}
+
+function addMessage(role, content) {
+    const messageDiv = document.createElement('div');
+    messageDiv.className = `message ${role}`;
+    
+    const avatar = role === 'user' ? '👤' : (chatMode === 'search' ? '🔍' : '🤖');
+    const timestamp = new Date().toISOString().slice(0, 19);
+    
+    messageDiv.innerHTML = `
+        <div class="message-avatar">${avatar}</div>
+        <div>
+            <div class="message-content">${content}</div>
+            <div class="message-time">${timestamp}</div>
+        </div>
+    `;
+    
+    chatMessages.insertBefore(messageDiv, typingIndicator);
+    scrollToBottom();
+    return messageDiv.querySelector('.message-content');
+}
+
+function showTypingIndicator() {
+    typingIndicator.style.display = 'block';
+    scrollToBottom();
+}
+
+function hideTypingIndicator() {
+    typingIndicator.style.display = 'none';
+}
+
+function setInputState(enabled) {
+    isWaitingForResponse = !enabled;
+    messageInput.disabled = !enabled;
+    sendButton.disabled = !enabled;
+    
+    if (enabled) {
+        messageInput.focus();
+    }
+}
+
+function showError(message) {
+    errorText.textContent = message;
+    errorMessage.style.display = 'block';
+}
+
+function hideError() {
+    errorMessage.style.display = 'none';
+}
+
+async function retryLastMessage() {
+    if (lastUserMessage) {
+        messageInput.value = lastUserMessage;
+        await sendMessage();
+    }
+}
+
+async function completeConversation() {
+    try {
+        const response = await fetch(`/api/sessions/${sessionId}/export`, {
+            method: 'POST'
+        });
+        
+        if (response.ok) {
+            // 只显示简单的完成提示
+            alert('对话已完成！');
+        } else {
+            const error = await response.json();
+            alert('保存对话失败: ' + (error.detail || '未知错误'));
+        }
+    } catch (error) {
+        alert('保存对话失败，请重试: ' + error.message);
+    }
+}
+
+function copySessionId() {
+    const sessionIdText = sessionId;
+    navigator.clipboard.writeText(sessionIdText).then(function() {
+        // 临时改变按钮文本来提供反馈
+        const button = document.querySelector('.copy-button');
+        const originalText = button.textContent;
+        button.textContent = '已复制!';
+        button.style.background = '#28a745';
+        
+        setTimeout(function() {
+            button.textContent = originalText;
+            button.style.background = '#007bff';
+        }, 2000);
+    }).catch(function(err) {
+        console.error('复制失败: ', err);
+        alert('复制失败，请手动复制: ' + sessionIdText);
+    });
+}
+
+// Scroll to bottom function
+function scrollToBottom() {
+    chatMessages.scrollTop = chatMessages.scrollHeight;
+}
+
+// Initial focus
+messageInput.focus();
+scrollToBottom();